@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        # Connects the signal handlers which keep the precomputed summaries up to date
+        from core import signals
+        # Registers the check that the filters of the list endpoints are indexed
+        from core import checks
@@ -0,0 +1,214 @@
+"""
+Bulk create, update and delete for the list endpoints, so that a register of hundreds of permits is one request rather
+than hundreds. Rows are validated in one pass, the objects they link to are fetched with one query per relation, and
+they are written with bulk_create or a CASE based bulk update. Everything the signals would have kept up to date is
+then brought in line with a few queries per request, see refresh_derived.
+"""
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Case, ManyToManyField, Value, When
+from django.db.models.functions import Cast
+from django.urls import Resolver404, get_script_prefix, resolve
+from django.utils import timezone
+from django.utils.six.moves.urllib import parse as urlparse
+from rest_framework import serializers
+from core import geometry, models, search, signals, summaries
+
+
+class PreloadedRelatedField(serializers.HyperlinkedRelatedField):
+    """
+    Hyperlinked relation which looks the objects up in preloaded, when BulkListSerializer has filled it in, rather
+    than with a query per row
+    """
+    preloaded = None
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        if self.preloaded is None:
+            return super(PreloadedRelatedField, self).get_object(view_name, view_args, view_kwargs)
+        try:
+            return self.preloaded[str(view_kwargs[self.lookup_url_kwarg])]
+        except KeyError:
+            raise ObjectDoesNotExist
+
+
+def url_lookup(field, url):
+    """The lookup value in a hyperlink, parsed as HyperlinkedRelatedField.to_internal_value does, or None"""
+    if not isinstance(url, str):
+        return None
+    path = urlparse.urlparse(url).path
+    prefix = get_script_prefix()
+    if path.startswith(prefix):
+        path = '/' + path[len(prefix):]
+    try:
+        return resolve(path).kwargs.get(field.lookup_url_kwarg)
+    except Resolver404:
+        return None
+
+
+def relation_fields(serializer):
+    """The writable hyperlinked relations of a serializer, by field name"""
+    relations = {}
+    for name, field in serializer.fields.items():
+        if field.read_only:
+            continue
+        relation = getattr(field, 'child_relation', field)
+        if isinstance(relation, PreloadedRelatedField):
+            relations[name] = relation
+    return relations
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    List serializer for the bulk endpoints. Validation returns the errors of each row, in the order of the rows, and
+    saving writes all the rows with a handful of queries.
+    """
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self.preload_relations(data)
+        return super(BulkListSerializer, self).to_internal_value(data)
+
+    def preload_relations(self, rows):
+        for name, field in relation_fields(self.child).items():
+            urls = []
+            for row in rows:
+                value = row.get(name) if isinstance(row, dict) else None
+                urls.extend(value if isinstance(value, list) else [value])
+            lookups = set(url_lookup(field, url) for url in urls) - {None}
+            field.preloaded = {}
+            if lookups:
+                queryset = field.get_queryset().filter(**{field.lookup_field + '__in': lookups})
+                field.preloaded = {str(getattr(obj, field.lookup_field)): obj for obj in queryset}
+
+    def split(self, attrs):
+        """Separates the many to many values of a validated row from the rest"""
+        model = self.child.Meta.model
+        many = {name: attrs.pop(name) for name in list(attrs)
+                if isinstance(model._meta.get_field(name), ManyToManyField)}
+        return attrs, many
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        instances, many = [], []
+        for attrs in validated_data:
+            attrs, related = self.split(dict(attrs))
+            instance = model(**attrs)
+            if type(instance) in geometry.GEOMETRY_FIELDS:
+                geometry.set_simplified(instance)
+            instances.append(instance)
+            many.append(related)
+        with signals.suspended():
+            model.objects.bulk_create(instances, batch_size=500)
+            set_many(model, instances, many)
+        refresh_derived(model, instances)
+        return instances
+
+    def update(self, instances, validated_data):
+        model = self.child.Meta.model
+        previous = [snapshot(instance) for instance in instances]
+        fields, many = set(), []
+        for instance, attrs in zip(instances, validated_data):
+            attrs, related = self.split(dict(attrs))
+            for name, value in attrs.items():
+                setattr(instance, name, value)
+                fields.add(name)
+            if type(instance) in geometry.GEOMETRY_FIELDS and geometry.GEOMETRY_FIELDS[type(instance)] in attrs:
+                geometry.set_simplified(instance)
+                fields.update(geometry.simplified_fields(geometry.GEOMETRY_FIELDS[type(instance)]))
+            many.append(related)
+        if any(field.name == 'updated_at' for field in model._meta.concrete_fields):
+            now = timezone.now()
+            for instance in instances:
+                instance.updated_at = now
+            fields.add('updated_at')
+
+        with signals.suspended():
+            bulk_update(model, instances, sorted(fields))
+            set_many(model, instances, many)
+        refresh_derived(model, instances, previous)
+        return instances
+
+
+def snapshot(instance):
+    """A copy of an instance's column values, as they were before an update"""
+    copy = type(instance)()
+    copy.__dict__.update({field.attname: instance.__dict__.get(field.attname)
+                          for field in instance._meta.concrete_fields})
+    return copy
+
+
+def bulk_update(model, instances, fields, batch_size=500):
+    """
+    Django 1.11 has no bulk_update, so write each batch of rows as a single
+    UPDATE ... SET field = CASE WHEN id = 1 THEN ... END WHERE id IN (...)
+    """
+    if not fields:
+        return
+    fields = [model._meta.get_field(name) for name in fields]
+    for start in range(0, len(instances), batch_size):
+        batch = instances[start:start + batch_size]
+        assignments = {
+            field.attname: Case(*[When(pk=instance.pk,
+                                       then=Cast(Value(getattr(instance, field.attname), output_field=field), field))
+                                  for instance in batch], output_field=field)
+            for field in fields
+        }
+        model.objects.filter(pk__in=[instance.pk for instance in batch]).update(**assignments)
+
+
+def set_many(model, instances, related):
+    """Replaces the many to many relations given for each instance, with one delete and one insert per relation"""
+    by_field = {}
+    for instance, values in zip(instances, related):
+        for name, objects in values.items():
+            by_field.setdefault(name, []).append((instance, objects))
+    for name, pairs in by_field.items():
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        source, target = field.m2m_field_name() + '_id', field.m2m_reverse_field_name() + '_id'
+        through.objects.filter(**{source + '__in': [instance.pk for instance, objects in pairs]}).delete()
+        through.objects.bulk_create([through(**{source: instance.pk, target: obj.pk})
+                                     for instance, objects in pairs for obj in objects], batch_size=500)
+
+
+def bulk_delete(queryset, pks):
+    """Deletes the rows with the given primary keys, returning the instances which were deleted"""
+    model = queryset.model
+    instances = list(queryset.filter(pk__in=pks))
+    cascaded = []
+    if model is models.Development:
+        # The permits go with the developments, and they are counted in the statistics too
+        cascaded = list(models.Permit.objects.filter(development__in=[instance.pk for instance in instances]))
+    with signals.suspended():
+        model.objects.filter(pk__in=[instance.pk for instance in instances]).delete()
+    # Deletes cascade to the tables below the one deleted from
+    models.TableVersion.bump(*signals.VERSIONED_MODELS)
+    refresh_derived(model, [], instances)
+    if cascaded:
+        refresh_derived(models.Permit, [], cascaded)
+    return instances
+
+
+def refresh_derived(model, instances, previous=()):
+    """
+    Does for a bulk write what the signals do for a single save or delete, given the rows as they are now and as they
+    were before, with a few queries in all rather than some per row
+    """
+    rows = list(instances) + list(previous)
+    models.TableVersion.bump(model)
+    if model in search.VECTORS and instances:
+        search.refresh_vectors(model, [instance.pk for instance in instances])
+
+    if model is models.Permit:
+        signals.refresh_buckets(*[signals.permit_buckets(row) for row in rows])
+        developments = [row.development_id for row in rows]
+    elif model is models.Development:
+        signals.refresh_buckets(*[signals.development_buckets(row) for row in rows])
+        developments = [row.pk for row in rows]
+    elif model is models.Offset:
+        developments = models.Permit.objects.filter(pk__in=[row.permit_id for row in rows])\
+            .values_list('development', flat=True)
+    else:
+        offsets = set(row.offset_id for row in rows) - {None}
+        developments = [row.development_id for row in rows]
+        if offsets:
+            developments += list(signals.offset_developments(*offsets))
+    summaries.refresh(set(developments) - {None})
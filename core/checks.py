@@ -0,0 +1,95 @@
+"""
+System check that every filter and ordering the list endpoints expose is backed by an index, so that no query string
+can make the API fall back to a sequential scan. Runs with the other checks, e.g. on manage.py check or runserver.
+"""
+from django.contrib.postgres.indexes import GinIndex
+from django.core import checks
+from django.db.models.lookups import Exact
+from rest_framework.filters import OrderingFilter
+from rest_framework.generics import GenericAPIView
+from rest_framework_gis.filters import DistanceToPointFilter, InBBoxFilter
+
+# Lookups only a GIN index can serve, the rest are served by B-trees
+GIN_LOOKUPS = ('has_key', 'has_keys', 'has_any_keys', 'contains', 'contained_by')
+
+
+def pinned_fields(queryset):
+    """The fields a viewset's queryset always filters on, e.g. kind for the biodiversity proxy models"""
+    return {child.lhs.target.name for child in queryset.query.where.children
+            if isinstance(child, Exact) and hasattr(child.lhs, 'target')}
+
+
+def is_indexed(model, field, lookup, pinned=()):
+    """Whether a lookup on a field can be answered from an index, given the fields already filtered on"""
+    if getattr(field, 'geom_type', None):
+        return field.spatial_index
+    gin = lookup in GIN_LOOKUPS
+    if not gin and (field.primary_key or field.unique or field.db_index):
+        return True
+    for index in model._meta.concrete_model._meta.indexes:
+        fields = [name.lstrip('-') for name in index.fields]
+        if isinstance(index, GinIndex) == gin and field.name in fields \
+                and all(name in pinned for name in fields[:fields.index(field.name)]):
+            return True
+    return False
+
+
+def resolve(model, path):
+    """Follows a lookup path such as permit__development, returning the model and field of each step"""
+    steps = []
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        steps.append((model, field))
+        if field.is_relation:
+            model = field.related_model
+    return steps
+
+
+def unindexed_paths(model, paths, pinned):
+    """The (path, lookup) pairs whose final field, or any relation followed on the way, has no index"""
+    for path, lookup in paths:
+        steps = resolve(model, path)
+        joins_indexed = all(field.concrete and (field.db_index or field.unique) for step_model, field in steps[:-1])
+        step_model, field = steps[-1]
+        if not joins_indexed or not is_indexed(step_model, field, lookup, pinned if step_model is model else ()):
+            yield path, lookup
+
+
+def viewset_paths(viewset):
+    """The (path, lookup) pairs a viewset can be filtered and ordered on"""
+    backends = getattr(viewset, 'filter_backends', ())
+    paths = []
+    filter_class = getattr(viewset, 'filter_class', None)
+    if filter_class is not None:
+        paths += [(item.name, item.lookup_expr) for item in filter_class.base_filters.values()]
+    paths += [(name, 'ordering') for name in getattr(viewset, 'ordering_fields', None) or ()]
+    if InBBoxFilter in backends:
+        paths.append((viewset.bbox_filter_field, 'bboverlaps'))
+    if DistanceToPointFilter in backends:
+        paths.append((viewset.distance_filter_field, 'dwithin'))
+    return paths
+
+
+@checks.register()
+def check_filter_indexes(app_configs, **kwargs):
+    from core import views
+    errors = []
+    for viewset in vars(views).values():
+        if not (isinstance(viewset, type) and issubclass(viewset, GenericAPIView)) or viewset.queryset is None:
+            continue
+        model = viewset.queryset.model
+        if OrderingFilter in viewset.filter_backends and getattr(viewset, 'ordering_fields', None) is None:
+            errors.append(checks.Error(
+                '{} can be ordered on any of its fields'.format(viewset.__name__),
+                hint='List the indexed fields it may be ordered on in ordering_fields',
+                obj=viewset,
+                id='core.E002',
+            ))
+        for path, lookup in unindexed_paths(model, viewset_paths(viewset), pinned_fields(viewset.queryset)):
+            errors.append(checks.Error(
+                '{} filters or orders on {}__{} which no index covers'.format(viewset.__name__, path, lookup),
+                hint='Add a db_index, or a models.Index or GinIndex to {}.Meta.indexes'.format(model.__name__),
+                obj=viewset,
+                id='core.E001',
+            ))
+    return errors
@@ -0,0 +1,94 @@
+"""
+Filters for the list endpoints, e.g. /permits?date_issued__gte=2015-01-01&permit_name=3. Every filter, and every field
+the endpoints can be ordered on, must be backed by an index, which core.checks makes sure of.
+"""
+from django_filters import rest_framework as django_filters
+from rest_framework_gis.filters import GeometryFilter
+from core import models
+
+CHOICE_LOOKUPS = ['exact', 'in']
+RANGE_LOOKUPS = ['exact', 'gte', 'lte']
+
+
+class DevelopmentFilter(django_filters.FilterSet):
+    vegetation_type = django_filters.CharFilter(name='geo_info', lookup_expr='has_key')
+
+    class Meta:
+        model = models.Development
+        fields = {
+            'use': CHOICE_LOOKUPS,
+        }
+
+
+class DevelopmentGeoFilter(DevelopmentFilter):
+    """Also lets the map fetch only the developments whose footprint intersects a GeoJSON or WKT geometry"""
+    intersects = GeometryFilter(name='footprint', lookup_expr='intersects')
+
+    class Meta(DevelopmentFilter.Meta):
+        pass
+
+
+class PermitFilter(django_filters.FilterSet):
+    class Meta:
+        model = models.Permit
+        fields = {
+            'permit_name': ['exact'],
+            'development': ['exact'],
+            'date_issued': RANGE_LOOKUPS,
+        }
+
+
+class OffsetFilter(django_filters.FilterSet):
+    # Offsets belong to a development through their permit
+    development = django_filters.NumberFilter(name='permit__development')
+
+    class Meta:
+        model = models.Offset
+        fields = {
+            'permit': ['exact'],
+            'offset_met': CHOICE_LOOKUPS,
+            'duration': CHOICE_LOOKUPS,
+            'type': CHOICE_LOOKUPS,
+        }
+
+
+class OffsetGeoFilter(OffsetFilter):
+    """Also lets the map fetch only the offsets whose polygon intersects a GeoJSON or WKT geometry"""
+    intersects = GeometryFilter(name='polygon', lookup_expr='intersects')
+
+    class Meta(OffsetFilter.Meta):
+        pass
+
+
+class BiodiversityLossFilter(django_filters.FilterSet):
+    class Meta:
+        model = models.BiodiversityLoss
+        fields = {
+            'development': ['exact'],
+            'type': ['exact'],
+            'name': ['exact'],
+        }
+
+
+class BiodiversityGainFilter(django_filters.FilterSet):
+    class Meta:
+        model = models.BiodiversityGain
+        fields = {
+            'offset': ['exact'],
+            'type': ['exact'],
+            'name': ['exact'],
+        }
+
+
+class DevelopmentOffsetSummaryFilter(django_filters.FilterSet):
+    """Ranges on the offset balance, e.g. ?ratio__lt=1 for the developments whose losses aren't covered by their gains"""
+    ecosystem = django_filters.CharFilter(name='ecosystem_counts', lookup_expr='has_key')
+
+    class Meta:
+        model = models.DevelopmentOffsetSummary
+        fields = {
+            'total_loss': ['gte', 'lte'],
+            'total_gain': ['gte', 'lte'],
+            'ratio': ['gte', 'lt', 'isnull'],
+            'development__use': ['exact'],
+        }
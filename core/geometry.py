@@ -0,0 +1,131 @@
+"""
+Simplified copies of the development footprints and offset polygons, so that the geo endpoints don't send vertices
+which can't be seen at the zoom level the map is showing.
+"""
+from django.contrib.gis.db.models import MultiPolygonField
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
+from django.db import connection
+from django.db.models import Func
+from core import models
+
+# Zoom levels which have a precomputed simplified geometry column, e.g. Development.footprint_z5
+ZOOM_LEVELS = (5, 8, 11)
+
+# At or beyond this zoom level the full resolution geometry is returned
+FULL_RESOLUTION_ZOOM = 14
+
+# The geometry field of each model with simplified columns
+GEOMETRY_FIELDS = {
+    models.Development: 'footprint',
+    models.Offset: 'polygon',
+}
+
+
+class SimplifyPreserveTopology(Func):
+    function = 'ST_SimplifyPreserveTopology'
+    template = 'ST_Multi(%(function)s(%(expressions)s))'
+
+    def __init__(self, expression, tolerance, **extra):
+        extra.setdefault('output_field', MultiPolygonField(srid=4326))
+        super(SimplifyPreserveTopology, self).__init__(expression, tolerance, **extra)
+
+
+def zoom_tolerance(zoom):
+    """The size of a 256px web map tile's pixel in degrees at a zoom level, anything smaller can't be seen"""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def simplified_field(geometry_field, zoom):
+    return '{}_z{}'.format(geometry_field, zoom)
+
+
+def simplified_fields(geometry_field):
+    return [simplified_field(geometry_field, zoom) for zoom in ZOOM_LEVELS]
+
+
+def precomputed_zoom(zoom):
+    """The coarsest precomputed zoom level which is at least as detailed as the requested one, if there is one"""
+    for level in ZOOM_LEVELS:
+        if level >= zoom:
+            return level
+    return None
+
+
+def simplify(geometry, tolerance):
+    """Simplifies a (multi)polygon without breaking its topology, always returning a MultiPolygon"""
+    if geometry is None:
+        return None
+    simplified = geometry.simplify(tolerance, preserve_topology=True)
+    if simplified.geom_type == 'Polygon':
+        simplified = MultiPolygon(simplified, srid=geometry.srid)
+    return simplified
+
+
+def set_simplified(instance):
+    """Fills in the simplified columns of an unsaved development or offset from its full geometry"""
+    geometry_field = GEOMETRY_FIELDS[type(instance)]
+    geometry = getattr(instance, geometry_field)
+    for zoom in ZOOM_LEVELS:
+        setattr(instance, simplified_field(geometry_field, zoom), simplify(geometry, zoom_tolerance(zoom)))
+
+
+def refresh_simplified(model):
+    """Recomputes the simplified columns of a whole table in the database, used after bulk loads"""
+    geometry_field = GEOMETRY_FIELDS[model]
+    assignments = ', '.join(
+        '{column} = ST_Multi(ST_SimplifyPreserveTopology({geometry}, {tolerance!r}))'.format(
+            column=simplified_field(geometry_field, zoom), geometry=geometry_field, tolerance=zoom_tolerance(zoom))
+        for zoom in ZOOM_LEVELS)
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE {table} SET {assignments}'.format(table=model._meta.db_table, assignments=assignments))
+
+
+# Checks and repairs a batch of geometries in one query. Geometries without an SRID are given the target one and any
+# other SRID is reprojected, repeated vertices are removed, ST_MakeValid fixes self-intersections and the like, and
+# only the polygonal parts of the result are kept, always as a MultiPolygon.
+REPAIR_SQL = """
+    WITH input AS (
+        SELECT position, geometry::geometry AS geometry
+        FROM unnest(%(geometries)s::text[]) WITH ORDINALITY AS t(geometry, position)
+    ), located AS (
+        SELECT position, ST_SRID(geometry) AS srid,
+               CASE WHEN ST_SRID(geometry) = 0 THEN ST_SetSRID(geometry, %(srid)s)
+                    WHEN ST_SRID(geometry) != %(srid)s THEN ST_Transform(geometry, %(srid)s)
+                    ELSE geometry END AS geometry
+        FROM input
+    )
+    SELECT srid, ST_IsValidReason(geometry), ST_NPoints(geometry) - ST_NPoints(ST_RemoveRepeatedPoints(geometry)),
+           ST_AsEWKB(repaired), ST_IsEmpty(repaired)
+    FROM located, LATERAL (
+        SELECT ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_RemoveRepeatedPoints(geometry)), 3)) AS repaired
+    ) AS repair
+    ORDER BY position
+"""
+
+
+def repair_many(geometries, srid=4326):
+    """
+    Validates and repairs a batch of (multi)polygons in the database. Returns a list in the same order with the
+    repaired MultiPolygon (None if nothing polygonal is left) and the faults which were found in each geometry.
+    """
+    if not geometries:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(REPAIR_SQL, {'geometries': [geometry.hexewkb.decode('ascii') for geometry in geometries],
+                                    'srid': srid})
+        results = []
+        for original_srid, reason, repeated, repaired, empty in cursor.fetchall():
+            faults = []
+            if original_srid == 0:
+                faults.append('missing SRID')
+            elif original_srid != srid:
+                faults.append('reprojected from SRID {}'.format(original_srid))
+            if repeated:
+                faults.append('repeated vertices')
+            if reason != 'Valid Geometry':
+                # e.g. Self-intersection[18.42 -33.91]
+                faults.append(reason.split('[')[0])
+            if empty:
+                faults.append('no polygon left after repair')
+            results.append((None if empty else GEOSGeometry(memoryview(repaired)), faults))
+    return results
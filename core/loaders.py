@@ -0,0 +1,188 @@
+"""
+Loads reference layers (vegetation types, provinces, protected areas) with PostgreSQL's COPY instead of an INSERT per
+feature. The rows are copied into a staging table without any indexes, the indexes (including the GiST index on the
+geometry) are built once the data is in, and the staging table then replaces the live one in a single transaction, so
+readers see either the old layer or the new one. Features which can't be loaded are written to a log file rather than
+stopping the load. Foreign keys from the swapped tables are recreated, but no other table may have foreign keys to
+them, as their rows get new ids.
+"""
+from datetime import date, datetime
+import io
+import json
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import MultiPolygon
+from django.db import DatabaseError, connection, transaction
+
+# Postgres identifiers are cut off at this length
+MAX_NAME_LENGTH = 63
+
+
+def staging_name(name):
+    return name[:MAX_NAME_LENGTH - 4] + '_new'
+
+
+def copy_value(field, value):
+    """Formats a value for COPY's text format, geometries as hex EWKB in the column's SRID"""
+    if value is None:
+        return r'\N'
+    if isinstance(field, GeometryField):
+        if value.srid is None:
+            value.srid = field.srid
+        elif value.srid != field.srid:
+            value = value.transform(field.srid, clone=True)
+        return value.hexewkb.decode('ascii')
+    if isinstance(value, (date, datetime)):
+        text = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value)
+    elif isinstance(value, bool):
+        text = 't' if value else 'f'
+    else:
+        text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def clean_row(fields, values):
+    """
+    The row of values COPY writes for a dict of field name to value, raising ValueError for anything the column would
+    refuse: a missing required value, a string longer than max_length or a geometry of another type. Polygons going
+    into MultiPolygon columns are converted.
+    """
+    row = []
+    for field in fields:
+        value = values[field.name] if field.name in values else field.get_default()
+        if value is None:
+            if not field.null:
+                raise ValueError('no ' + ('geometry' if isinstance(field, GeometryField) else field.name))
+        elif isinstance(field, GeometryField):
+            if field.geom_type == 'MULTIPOLYGON' and value.geom_type == 'Polygon':
+                value = MultiPolygon(value, srid=value.srid)
+            if field.geom_type != 'GEOMETRY' and value.geom_type.upper() != field.geom_type:
+                raise ValueError('{} is a {}, not a {}'.format(field.name, value.geom_type, field.geom_type))
+        elif field.max_length is not None and len(str(value)) > field.max_length:
+            raise ValueError('{} is longer than {} characters'.format(field.name, field.max_length))
+        row.append(value)
+    return row
+
+
+def copy_rows(cursor, table, fields, rows):
+    """Streams rows of python values into a table with a single COPY"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(field, value) for field, value in zip(fields, row)))
+        buffer.write('\n')
+    buffer.seek(0)
+    # copy_expert isn't one of the cursor methods Django translates the driver's errors for
+    with connection.wrap_database_errors:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+            table, ', '.join(connection.ops.quote_name(field.column) for field in fields)), buffer)
+
+
+def table_indexes(cursor, table):
+    """The primary key constraint and the definitions of the other indexes on a table"""
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", [table])
+    primary_key = cursor.fetchone()[0]
+    cursor.execute('SELECT indexname, indexdef FROM pg_indexes '
+                   'WHERE schemaname = current_schema() AND tablename = %s AND indexname != %s',
+                   [table, primary_key])
+    return primary_key, cursor.fetchall()
+
+
+def log_rejected(log, number, feature, error):
+    log.write(json.dumps({'feature': number, 'properties': feature.properties, 'error': repr(error)},
+                         default=str) + '\n')
+
+
+def foreign_keys(cursor, table):
+    """The definitions of the foreign keys from a table, and the names of the tables with foreign keys to it"""
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+    outgoing = cursor.fetchall()
+    cursor.execute("SELECT DISTINCT conrelid::regclass::text FROM pg_constraint "
+                   "WHERE confrelid = %s::regclass AND contype = 'f'", [table])
+    return outgoing, [name for name, in cursor.fetchall()]
+
+
+def copy_replace(model, batches, build, reject_log, keep=None):
+    """
+    Replaces the rows of a model's table with the features in batches (see helpers.iter_features), which build turns
+    into a dict of field name to value. Features build fails on, which clean_row finds the table can't hold, or which
+    the database still refuses, are written to the reject_log file as JSON lines. Rows of the existing table in the
+    keep queryset are carried over unchanged. Returns the number of rows loaded, kept and rejected.
+    """
+    table = model._meta.db_table
+    staging = staging_name(table)
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    counts = {'loaded': 0, 'kept': 0, 'rejected': 0}
+
+    with transaction.atomic(), connection.cursor() as cursor, open(reject_log, 'w') as log:
+        constraints, referenced_by = foreign_keys(cursor, table)
+        if referenced_by:
+            raise ValueError('{} can not be replaced, {} have foreign keys to its rows'.format(
+                table, ', '.join(referenced_by)))
+
+        cursor.execute('DROP TABLE IF EXISTS {staging}'.format(staging=quote(staging)))
+        cursor.execute('CREATE TABLE {staging} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+            staging=quote(staging), table=quote(table)))
+
+        if keep is not None:
+            columns = model._meta.concrete_fields
+            sql, params = keep.values_list(*[field.attname for field in columns]).query.sql_with_params()
+            cursor.execute('INSERT INTO {staging} ({columns}) {sql}'.format(
+                staging=quote(staging), sql=sql, columns=', '.join(quote(field.column) for field in columns)), params)
+            counts['kept'] = cursor.rowcount
+
+        number = 0
+        for batch in batches:
+            built = []
+            for feature in batch:
+                number += 1
+                try:
+                    built.append((number, feature, clean_row(fields, build(feature))))
+                except (KeyError, TypeError, ValueError) as e:
+                    log_rejected(log, number, feature, e)
+                    counts['rejected'] += 1
+            try:
+                with transaction.atomic():
+                    copy_rows(cursor, quote(staging), fields, [row for _, _, row in built])
+                counts['loaded'] += len(built)
+            except DatabaseError:
+                # Something got past clean_row, copy the batch a row at a time to find out which rows it was
+                for row_number, feature, row in built:
+                    try:
+                        with transaction.atomic():
+                            copy_rows(cursor, quote(staging), fields, [row])
+                        counts['loaded'] += 1
+                    except DatabaseError as e:
+                        log_rejected(log, row_number, feature, e)
+                        counts['rejected'] += 1
+
+        # Building the indexes once the rows are in is much quicker than keeping them up to date row by row
+        primary_key, indexes = table_indexes(cursor, table)
+        cursor.execute('ALTER TABLE {staging} ADD CONSTRAINT {name} PRIMARY KEY ({pk})'.format(
+            staging=quote(staging), name=quote(staging_name(primary_key)), pk=quote(model._meta.pk.column)))
+        for name, definition in indexes:
+            definition = definition.replace(' INDEX {} ON '.format(name),
+                                            ' INDEX {} ON '.format(quote(staging_name(name))), 1)
+            definition = definition.replace(' ON {} '.format(table), ' ON {} '.format(quote(staging)), 1)
+            definition = definition.replace(' ON public.{} '.format(table), ' ON {} '.format(quote(staging)), 1)
+            cursor.execute(definition)
+        cursor.execute('ANALYZE {staging}'.format(staging=quote(staging)))
+
+        # The id sequence belongs to the old table, and would be dropped with it
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, model._meta.pk.column])
+        sequence = cursor.fetchone()[0]
+        if sequence:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY NONE'.format(sequence))
+        cursor.execute('DROP TABLE {table}'.format(table=quote(table)))
+        cursor.execute('ALTER TABLE {staging} RENAME TO {table}'.format(staging=quote(staging), table=quote(table)))
+        for name in [primary_key] + [name for name, _ in indexes]:
+            cursor.execute('ALTER INDEX {} RENAME TO {}'.format(quote(staging_name(name)), quote(name)))
+        if sequence:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(sequence, quote(table),
+                                                                      quote(model._meta.pk.column)))
+        # CREATE TABLE ... LIKE doesn't copy foreign keys, and the old table's went with it
+        for name, definition in constraints:
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(quote(table), quote(name), definition))
+    return counts
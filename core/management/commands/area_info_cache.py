@@ -0,0 +1,36 @@
+import json
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management.base import BaseCommand
+from core import models, services
+
+
+class Command(BaseCommand):
+    help = 'Pre-warms, exports or purges the cache of VegMap identify results used by core.services.get_area_info.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--import', dest='import_path',
+                            help='JSON file of {"key" or "geometry", "info"} entries to load into the cache.')
+        parser.add_argument('--export', dest='export_path',
+                            help='Write every cached entry to this JSON file, which can be imported again offline.')
+        parser.add_argument('--purge', action='store_true',
+                            help='Remove expired entries and trim the cache to AREA_INFO_CACHE_MAX_ENTRIES.')
+
+    def handle(self, *args, **options):
+        if options['import_path']:
+            with open(options['import_path']) as file_obj:
+                entries = json.load(file_obj)
+            for entry in entries:
+                key = entry.get('key') or services.geometry_key(GEOSGeometry(json.dumps(entry['geometry'])))
+                services.cache_area_info(key, entry['info'])
+            self.stdout.write('Imported {} entries'.format(len(entries)))
+
+        if options['export_path']:
+            entries = [{'key': key, 'info': info} for key, info in models.AreaInfo.objects.values_list('key', 'info')]
+            with open(options['export_path'], 'w') as file_obj:
+                json.dump(entries, file_obj)
+            self.stdout.write('Exported {} entries'.format(len(entries)))
+
+        if options['purge']:
+            self.stdout.write('Purged {} entries'.format(services.purge_area_info_cache()))
+
+        self.stdout.write('{} entries cached'.format(models.AreaInfo.objects.count()))
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# The queries behind the biodiversity endpoints, for the multi-table layout before migration 0015 and the single
+# table after it, so the same command can be run on either side of the migration and the timings compared
+QUERIES = {
+    'multi-table': OrderedDict([
+        ('list losses', 'SELECT b.id, b.type, b.name, b.size, l.development_id FROM core_biodiversityloss AS l '
+                        'JOIN core_biodiversity AS b ON b.id = l.biodiversity_ptr_id '
+                        'ORDER BY l.biodiversity_ptr_id LIMIT 50'),
+        ('list gains', 'SELECT b.id, b.type, b.name, b.size, g.offset_id FROM core_biodiversitygain AS g '
+                       'JOIN core_biodiversity AS b ON b.id = g.biodiversity_ptr_id '
+                       'ORDER BY g.biodiversity_ptr_id LIMIT 50'),
+        ('losses of a development by type', 'SELECT b.id, b.name, b.size FROM core_biodiversityloss AS l '
+                                            'JOIN core_biodiversity AS b ON b.id = l.biodiversity_ptr_id '
+                                            'WHERE l.development_id = %(development)s AND b.type = %(type)s'),
+        ('gains of an offset by type', 'SELECT b.id, b.name, b.size FROM core_biodiversitygain AS g '
+                                       'JOIN core_biodiversity AS b ON b.id = g.biodiversity_ptr_id '
+                                       'WHERE g.offset_id = %(offset)s AND b.type = %(type)s'),
+        ('losses by name', 'SELECT b.id, l.development_id FROM core_biodiversityloss AS l '
+                           'JOIN core_biodiversity AS b ON b.id = l.biodiversity_ptr_id WHERE b.name = %(name)s'),
+    ]),
+    'single-table': OrderedDict([
+        ('list losses', "SELECT id, type, name, size, development_id FROM core_biodiversity WHERE kind = 'L' "
+                        "ORDER BY id LIMIT 50"),
+        ('list gains', "SELECT id, type, name, size, offset_id FROM core_biodiversity WHERE kind = 'G' "
+                       "ORDER BY id LIMIT 50"),
+        ('losses of a development by type', 'SELECT id, name, size FROM core_biodiversity '
+                                            'WHERE development_id = %(development)s AND type = %(type)s'),
+        ('gains of an offset by type', 'SELECT id, name, size FROM core_biodiversity '
+                                       'WHERE offset_id = %(offset)s AND type = %(type)s'),
+        ('losses by name', "SELECT id, development_id FROM core_biodiversity WHERE kind = 'L' AND name = %(name)s"),
+    ]),
+}
+
+# The busiest development and offset, and the commonest name, make for the slowest filters
+SAMPLE_SQL = {
+    'multi-table': {
+        'development': 'SELECT development_id FROM core_biodiversityloss GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1',
+        'offset': 'SELECT offset_id FROM core_biodiversitygain GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1',
+    },
+    'single-table': {
+        'development': 'SELECT development_id FROM core_biodiversity WHERE development_id IS NOT NULL '
+                       'GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1',
+        'offset': 'SELECT offset_id FROM core_biodiversity WHERE offset_id IS NOT NULL '
+                  'GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1',
+    },
+}
+
+
+class Command(BaseCommand):
+    help = 'Times the list and filter queries of the biodiversity endpoints. Run it before and after migrating to ' \
+           'core 0015 to compare the multi-table and single table layouts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help='How many times to run each query.')
+
+    def handle(self, *args, **options):
+        layout = 'multi-table' if 'core_biodiversityloss' in connection.introspection.table_names() else 'single-table'
+        with connection.cursor() as cursor:
+            params = {'type': 'E', 'name': self.sample(cursor, 'SELECT name FROM core_biodiversity GROUP BY 1 '
+                                                               'ORDER BY COUNT(*) DESC LIMIT 1')}
+            for name, sql in SAMPLE_SQL[layout].items():
+                params[name] = self.sample(cursor, sql)
+            cursor.execute('SELECT COUNT(*) FROM core_biodiversity')
+            self.stdout.write('{} layout, {} rows, {} runs per query'.format(
+                layout, cursor.fetchone()[0], options['repeat']))
+
+            for name, sql in QUERIES[layout].items():
+                timings = sorted(self.time(cursor, sql, params) for i in range(options['repeat']))
+                self.stdout.write('{:<34} median {:8.3f} ms   p95 {:8.3f} ms'.format(
+                    name, timings[len(timings) // 2], timings[int((len(timings) - 1) * 0.95)]))
+
+    def sample(self, cursor, sql):
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def time(self, cursor, sql, params):
+        started = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        return (time.perf_counter() - started) * 1000
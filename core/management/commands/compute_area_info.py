@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import models, services
+
+
+class Command(BaseCommand):
+    help = 'Fills in the vegetation type hectares of every development and offset from the local VegMap polygons.'
+
+    def handle(self, *args, **options):
+        if not models.VegetationType.objects.exists():
+            self.stderr.write('There are no vegetation types loaded, run helpers.load_vegetation_types() first')
+            return
+        updated = services.compute_area_info()
+        self.stdout.write(self.style.SUCCESS('Updated {development} developments and {offset} offsets'.format(**updated)))
@@ -0,0 +1,425 @@
+from collections import Counter, OrderedDict
+from itertools import islice
+from multiprocessing import Manager, Pool
+from os.path import join
+import time
+import zlib
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils import timezone
+from core import bulk, geometry, helpers, models, search, services, signals, statistics, summaries
+
+
+def batches(iterable, size):
+    """Splits an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def shard_of(uid, shards):
+    """The shard a spreadsheet row is built in, the same for a given unique_id on every run"""
+    return zlib.crc32(uid.encode('utf-8')) % shards
+
+
+class RecordBuilder(object):
+    """
+    Turns spreadsheet rows into unsaved model instances, looking up their vegetation types on the way. It only reads
+    the input files and the AreaInfo cache, so it can run in worker processes while the command does all the writing.
+    Messages for the log are collected in messages rather than printed, and the cache entries used and the info
+    fetched from the identify service in area_info_used and area_info_fresh, for the command to write to the cache.
+    """
+    def __init__(self, devs, offsets, dev_infos, permit_names, implementation_times, local_vegetation, stored=None):
+        self.devs = devs
+        self.offsets = offsets
+        self.dev_infos = dev_infos
+        self.permit_names = permit_names
+        self.implementation_times = implementation_times
+        self.local_vegetation = local_vegetation
+        # The ids of the developments stored by an earlier load, keyed on unique_id, for --incremental
+        self.stored = stored
+        # Vegetation lookups the command has made this run, which workers can't read from the cache until it commits
+        self.pending_area_info = None
+        self.reset()
+
+    def reset(self):
+        """Clears what was collected for the last batch"""
+        self.messages = []
+        self.lookup_failures = 0
+        # Geometry faults repaired, by class, see geometry.repair_many
+        self.faults = Counter()
+        self.area_info_used = []
+        self.area_info_fresh = OrderedDict()
+
+    def row_hashes(self, row):
+        """The source hashes of the development and the offset built from a spreadsheet row"""
+        uid = row['unique_id']
+        development_hash = helpers.source_hash(row, self.dev_infos[uid], self.devs[uid]['polygon'])
+        offset_hash = None
+        # Offsets are only loaded for rows with a permit to attach them to
+        if uid in self.offsets and any(row.get(column) for column, _ in helpers.PERMIT_COLUMNS):
+            offset_hash = helpers.source_hash(self.offsets[uid]['polygon'])
+        return development_hash, offset_hash
+
+    def repair_polygons(self, rows):
+        """Validates and repairs the development and offset polygons of a batch of rows, keyed on ('dev', uid)"""
+        polygons = OrderedDict()
+        for row in rows:
+            uid = row['unique_id']
+            polygons[('dev', uid)] = self.devs[uid]['polygon']
+            if uid in self.offsets:
+                polygons[('offset', uid)] = self.offsets[uid]['polygon']
+
+        repaired = OrderedDict()
+        for key, (polygon, faults) in zip(polygons, geometry.repair_many(list(polygons.values()))):
+            self.faults.update(faults)
+            if polygon is None:
+                self.messages.append('no usable polygon for {} {}: {}'.format(key[0], key[1], ', '.join(faults)))
+            repaired[key] = polygon
+        return repaired
+
+    def lookup_area_info(self, polygons):
+        """Looks up the vegetation types of every development and offset polygon in the batch at once"""
+        if self.local_vegetation:
+            # These are computed for the whole load in the database once it is written
+            return {}
+
+        polygons = OrderedDict((key, polygon) for key, polygon in polygons.items() if polygon is not None)
+        results, used, fresh = services.lookup_area_info_many(list(polygons.values()), self.pending_area_info)
+        self.area_info_used.extend(used)
+        self.area_info_fresh.update(fresh)
+        infos = {}
+        for key, info in zip(polygons, results):
+            if isinstance(info, services.AreaInfoError):
+                self.messages.append('vegetation lookup failed for {} {}: {}'.format(key[0], key[1], info))
+                self.lookup_failures += 1
+                info = None
+            infos[key] = info
+        return infos
+
+    def build_record(self, row, polygons, infos):
+        """Builds the unsaved development, permits, offset and implementation times for a spreadsheet row"""
+        uid = row['unique_id']
+        dev_polygon = polygons[('dev', uid)]
+        offset_polygon = polygons.get(('offset', uid))
+        development = helpers.build_development(uid, row, self.dev_infos[uid], dev_polygon, infos.get(('dev', uid)))
+        development.source_hash, offset_hash = self.row_hashes(row)
+        if self.stored is not None:
+            # Changed developments are updated in place, so their ids and losses stay the same
+            development.pk = self.stored.get(uid, (None, None))[0]
+        permits = helpers.build_permits(row, self.dev_infos[uid], self.permit_names, offset_polygon is not None)
+
+        offset = None
+        i_times = []
+        if offset_polygon is None:
+            self.messages.append('no offsets uid for ' + uid)
+        elif not permits:
+            self.messages.append('no permit to attach the offset to for ' + uid)
+        else:
+            offset = helpers.build_offset(row, offset_polygon, infos.get(('offset', uid)))
+            offset.source_hash = offset_hash
+            i_times = [self.implementation_times[name] for name in helpers.implementation_time_names(row)]
+        return development, permits, offset, i_times
+
+    def build_records(self, rows):
+        polygons = self.repair_polygons(rows)
+        infos = self.lookup_area_info(polygons)
+        return [self.build_record(row, polygons, infos) for row in rows]
+
+
+# The builder of a worker process, see build_shard
+_builder = None
+
+
+def init_worker(builder):
+    global _builder
+    _builder = builder
+
+
+def build_shard(shard):
+    """
+    Builds the records of one shard of a batch in a worker process. Returns them with their positions in the batch,
+    along with the messages, the vegetation lookups to cache, their statistics and the time it took.
+    """
+    number, rows = shard
+    started = time.time()
+    _builder.reset()
+    cache_stats = dict(services.cache_stats)
+    records = _builder.build_records([row for _, row in rows])
+    return {
+        'shard': number,
+        'records': list(zip([index for index, _ in rows], records)),
+        'messages': _builder.messages,
+        'lookup_failures': _builder.lookup_failures,
+        'faults': _builder.faults,
+        'area_info_used': _builder.area_info_used,
+        'area_info_fresh': _builder.area_info_fresh,
+        'cache_stats': {key: value - cache_stats[key] for key, value in services.cache_stats.items()},
+        'seconds': time.time() - started,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Replaces all developments, permits and offsets with the ones in the offsets-data-sources input files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input-dir', default=helpers.INPUT_DIR,
+                            help='Directory containing the geojson and csv input files.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of spreadsheet rows written per bulk insert.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Run the whole load and then roll it back.')
+        parser.add_argument('--local-vegetation', action='store_true',
+                            help='Compute vegetation types from the local VegMap polygons instead of the identify '
+                                 'service.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only write the developments whose input rows or polygons changed since the last '
+                                 'load, and delete the ones no longer in the input, instead of replacing everything. '
+                                 'Changed developments keep their ids and losses, their permits and offsets are '
+                                 'rebuilt from the input and the gains on their offsets are moved onto the new ones.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes the rows are sharded across (on a hash of their unique_id) to '
+                                 'parse their geometries and look up their vegetation types. The writes, including '
+                                 'those to the vegetation lookup cache, are done by this process in one transaction '
+                                 'and in input order, so the result is the same for any number of workers.')
+
+    def handle(self, *args, **options):
+        input_dir = options['input_dir']
+        self.local_vegetation = options['local_vegetation']
+        self.incremental = options['incremental']
+        self.workers = max(options['workers'], 1)
+        self.shard_stats = {}
+        self.faults = Counter()
+        self.counts = {'rows': 0, 'developments': 0, 'permits': 0, 'offsets': 0, 'skipped': 0,
+                       'lookup_failures': 0, 'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        started = time.time()
+
+        self.devs = helpers.read_polygons(join(input_dir, 'development_sites.geojson'))
+        self.offsets = helpers.read_polygons(join(input_dir, 'offsets_receiving_areas.geojson'))
+        self.dev_infos = helpers.read_dev_infos(join(input_dir, 'dev_info_spreadsheet.csv'))
+        self.permit_names = {permit_name.name: permit_name for permit_name in models.PermitName.objects.all()}
+        self.implementation_times = {i_time.name: i_time for i_time in models.OffsetImplementationTime.objects.all()}
+
+        if self.incremental:
+            self.load_hashes()
+        self.builder = RecordBuilder(self.devs, self.offsets, self.dev_infos, self.permit_names,
+                                     self.implementation_times, self.local_vegetation,
+                                     self.stored if self.incremental else None)
+        self.pool = None
+        self.manager = None
+        if self.workers > 1:
+            # Forked workers mustn't share this process' database connection, they open their own
+            connections.close_all()
+            self.manager = Manager()
+            self.builder.pending_area_info = self.manager.dict()
+            self.pool = Pool(self.workers, initializer=init_worker, initargs=(self.builder,))
+
+        rows = helpers.iter_offset_rows(join(input_dir, 'offsets_spreadsheet.csv'))
+        try:
+            self.load(rows, started, options)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.manager.shutdown()
+
+        self.report(started, style=self.style.SUCCESS)
+        for shard, stats in sorted(self.shard_stats.items()):
+            self.stdout.write('Shard {}: {} rows in {:.1f} sec ({:.1f} rows/sec)'.format(
+                shard, stats['rows'], stats['seconds'], stats['rows'] / max(stats['seconds'], 0.001)))
+        self.stdout.write('Geometry faults repaired: ' + (', '.join(
+            '{} {}'.format(count, fault) for fault, count in sorted(self.faults.items())) or 'none'))
+        if self.incremental:
+            self.stdout.write('Developments: {new} new, {changed} changed, {unchanged} unchanged, {removed} '
+                              'removed'.format(**self.counts))
+        self.stdout.write('Vegetation lookups: {} cached, {} from the identify service, {} failed'.format(
+            services.cache_stats['hits'], services.cache_stats['misses'], services.cache_stats['failures']))
+
+    def load(self, rows, started, options):
+        with transaction.atomic(), signals.suspended():
+            if not self.incremental:
+                # Remove everything from the DB to start, permits and offsets cascade from the developments
+                models.Development.objects.all().delete()
+                models.Offset.objects.all().delete()
+
+            for batch in batches(rows, options['batch_size']):
+                self.write_batch(batch)
+                self.report(started)
+
+            if self.incremental:
+                self.remove_missing()
+
+            if self.local_vegetation:
+                self.stdout.write('Computing vegetation types: {development} developments, {offset} offsets'.format(
+                    **services.compute_area_info()))
+            # Bulk inserts skip the signals which keep these up to date
+            geometry.refresh_simplified(models.Development)
+            geometry.refresh_simplified(models.Offset)
+            search.refresh_vectors(models.Development)
+            search.refresh_vectors(models.Permit)
+            statistics.rebuild()
+            summaries.rebuild()
+            models.TableVersion.bump(*signals.VERSIONED_MODELS)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+                self.stdout.write('Dry run, rolling back')
+
+    def usable_rows(self, rows):
+        """Filters out the spreadsheet rows we don't have enough information for"""
+        usable = []
+        for row in rows:
+            uid = row['unique_id']
+            if uid not in self.dev_infos:
+                self.stdout.write('no corresponding info in main sheet for ' + uid)
+            elif uid not in self.devs:
+                self.stdout.write('skipping, no polygons available for ' + uid)
+            else:
+                usable.append(row)
+                continue
+            self.counts['skipped'] += 1
+        return usable
+
+    def load_hashes(self):
+        """Reads the hashes the previous load stored, for the developments and offsets it loaded"""
+        self.stored = {code: (pk, source_hash) for pk, code, source_hash in
+                       models.Development.objects.exclude(source_hash=None).values_list('pk', 'code', 'source_hash')}
+        self.stored_offsets = dict(models.Offset.objects.exclude(source_hash=None)
+                                   .values_list('permit__development__code', 'source_hash'))
+        self.seen = set()
+
+    def changed_rows(self, rows):
+        """Filters out the rows whose development and offset are stored exactly as they would be built now"""
+        changed = []
+        for row in rows:
+            uid = row['unique_id']
+            self.seen.add(uid)
+            pk, stored_hash = self.stored.get(uid, (None, None))
+            if pk is None:
+                self.counts['new'] += 1
+            elif self.builder.row_hashes(row) == (stored_hash, self.stored_offsets.get(uid)):
+                self.counts['unchanged'] += 1
+                continue
+            else:
+                self.counts['changed'] += 1
+            changed.append(row)
+        return changed
+
+    def remove_missing(self):
+        """Deletes the developments an earlier load wrote which are no longer in the input"""
+        missing = [pk for code, (pk, _) in self.stored.items() if code not in self.seen]
+        models.Development.objects.filter(pk__in=missing).delete()
+        self.counts['removed'] = len(missing)
+
+    def build_records(self, rows):
+        """
+        Builds the records of a batch of rows, in this process or sharded across the worker processes. Either way the
+        records come back in the order of the rows, and the vegetation lookups are cached by this process, so they are
+        part of the load's transaction. The workers are handed the lookups made so far through pending_area_info, so a
+        polygon seen in an earlier batch isn't looked up again.
+        """
+        if self.pool is None:
+            self.builder.reset()
+            started = time.time()
+            records = self.builder.build_records(rows)
+            results = [{'shard': 0, 'records': list(enumerate(records)), 'messages': self.builder.messages,
+                        'lookup_failures': self.builder.lookup_failures, 'faults': self.builder.faults,
+                        'area_info_used': self.builder.area_info_used,
+                        'area_info_fresh': self.builder.area_info_fresh,
+                        'cache_stats': {}, 'seconds': time.time() - started}]
+        else:
+            shards = [(number, []) for number in range(self.workers)]
+            for index, row in enumerate(rows):
+                shards[shard_of(row['unique_id'], self.workers)][1].append((index, row))
+            results = self.pool.map(build_shard, [shard for shard in shards if shard[1]])
+
+        records = []
+        for result in results:
+            records.extend(result['records'])
+            for message in result['messages']:
+                self.stdout.write(message)
+            self.counts['lookup_failures'] += result['lookup_failures']
+            self.faults.update(result['faults'])
+            services.record_area_info(result['area_info_used'], result['area_info_fresh'])
+            if self.pool is not None:
+                self.builder.pending_area_info.update(result['area_info_fresh'])
+            for key, value in result['cache_stats'].items():
+                services.cache_stats[key] += value
+            stats = self.shard_stats.setdefault(result['shard'], {'rows': 0, 'seconds': 0.0})
+            stats['rows'] += len(result['records'])
+            stats['seconds'] += result['seconds']
+        return [record for _, record in sorted(records, key=lambda item: item[0])]
+
+    def write_batch(self, rows):
+        """Bulk inserts a batch of spreadsheet rows, a handful of queries no matter how big the batch is"""
+        self.counts['rows'] += len(rows)
+        usable = self.usable_rows(rows)
+        if self.incremental:
+            usable = self.changed_rows(usable)
+        records = self.build_records(usable)
+
+        developments = [record[0] for record in records]
+        stored = [development for development in developments if development.pk is not None]
+        gains = []
+        if stored:
+            # Their permits are built again from the row, and the offsets and implementation times cascade from them.
+            # The gains recorded on the offsets an earlier load built are detached first, and moved onto the new ones.
+            gains = list(models.BiodiversityGain.objects
+                         .filter(offset__permit__development__in=stored, offset__source_hash__isnull=False)
+                         .values_list('pk', 'offset__permit__development'))
+            models.BiodiversityGain.objects.filter(pk__in=[pk for pk, _ in gains]).update(offset=None)
+            models.Permit.objects.filter(development__in=stored).delete()
+            now = timezone.now()
+            for development in stored:
+                development.updated_at = now
+            bulk.bulk_update(models.Development, stored, ['use', 'location_description', 'footprint', 'geo_info',
+                                                          'source_hash', 'updated_at'])
+        models.Development.objects.bulk_create([development for development in developments
+                                                if development.pk is None])
+
+        permits = []
+        for development, (_, record_permits, _, _) in zip(developments, records):
+            for permit in record_permits:
+                permit.development = development
+                permits.append(permit)
+        models.Permit.objects.bulk_create(permits)
+
+        offsets = []
+        for _, record_permits, offset, _ in records:
+            if offset is not None:
+                offset.permit = record_permits[0]
+                offsets.append(offset)
+        models.Offset.objects.bulk_create(offsets)
+
+        Through = models.Offset.implementation_times.through
+        Through.objects.bulk_create([
+            Through(offset_id=offset.pk, offsetimplementationtime_id=i_time.pk)
+            for _, _, offset, i_times in records if offset is not None
+            for i_time in i_times
+        ])
+        if gains:
+            self.move_gains(gains, records)
+
+        self.counts['developments'] += len(developments)
+        self.counts['permits'] += len(permits)
+        self.counts['offsets'] += len(offsets)
+
+    def move_gains(self, gains, records):
+        """
+        Moves the detached gains of the stored developments onto their new offsets. Gains of developments which no
+        longer have an offset are deleted, as they would have been along with the offset.
+        """
+        offsets = {development.pk: offset for development, _, offset, _ in records if offset is not None}
+        moved = [models.BiodiversityGain(pk=pk, offset=offsets[development_id])
+                 for pk, development_id in gains if development_id in offsets]
+        bulk.bulk_update(models.BiodiversityGain, moved, ['offset'])
+        models.BiodiversityGain.objects.filter(pk__in=[pk for pk, development_id in gains
+                                                      if development_id not in offsets]).delete()
+
+    def report(self, started, style=None):
+        elapsed = time.time() - started
+        message = '{rows} rows ({rate:.1f} rows/sec): {developments} developments, {permits} permits, ' \
+                  '{offsets} offsets, {skipped} skipped'.format(rate=self.counts['rows'] / max(elapsed, 0.001),
+                                                                **self.counts)
+        self.stdout.write(style(message) if style else message)
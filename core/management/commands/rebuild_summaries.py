@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import statistics, summaries
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the dashboard statistics and the development offset summaries from scratch. Run after bulk ' \
+           'loads, which skip the signals.'
+
+    def handle(self, *args, **options):
+        statistics.rebuild()
+        self.stdout.write(self.style.SUCCESS('Rebuilt the dashboard statistics'))
+        summaries.rebuild()
+        self.stdout.write(self.style.SUCCESS('Rebuilt the development offset summaries'))
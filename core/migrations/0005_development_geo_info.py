@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 07:10
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20171214_1009'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='development',
+            name='geo_info',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='The vegetation types intersecting the footprint, keyed by vegetation type name.', null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 07:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_development_geo_info'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chart', models.CharField(choices=[('DP', 'Number of developments per permit'), ('PY', 'Number of permits per year'), ('VT', 'Number of vegetation types (developments)')], max_length=2)),
+                ('key', models.CharField(help_text='Identifies the bucket within the chart, e.g. the permit name id or the year.', max_length=200)),
+                ('label', models.CharField(max_length=200)),
+                ('value', models.IntegerField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='statisticcount',
+            unique_together=set([('chart', 'key')]),
+        ),
+    ]
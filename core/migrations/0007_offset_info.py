@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 08:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_statisticcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offset',
+            name='info',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='The vegetation types intersecting the offset, keyed by vegetation type name.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='offset',
+            name='offset_met',
+            field=models.CharField(choices=[('ME', 'Yes, this offset has been met'), ('LA', 'No, this offset has not been met and the time has lapsed, it is outstanding.'), ('IP', 'No, this offset has not yet been met but the development is still in progress.'), ('NU', 'No, this offset has not been met for reasons unknown.'), ('NO', 'No, this offset has not been met because there is no offset area available.'), ('UN', "We don't know if this offset has been met or not.")], help_text='The status of the offset requirement (whether it has been met or not).', max_length=2),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 08:30
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_offset_info'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AreaInfo',
+            fields=[
+                ('key', models.CharField(help_text='SHA-256 of the normalized 2D WKB of the geometry.', max_length=64, primary_key=True, serialize=False)),
+                ('info', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_used', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
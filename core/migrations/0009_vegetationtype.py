@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 09:15
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_areainfo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VegetationType',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, help_text='The name of the vegetation type, e.g. Cape Flats Sand Fynbos.', max_length=200)),
+                ('biome', models.CharField(blank=True, max_length=100, null=True)),
+                ('polygon', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326)),
+            ],
+        ),
+    ]
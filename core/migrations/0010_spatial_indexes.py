@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 09:50
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Django creates these with the geometry columns, but the spatial filters on the geo endpoints depend on them so make
+# sure they exist on databases which were created or restored some other way
+ENSURE_GIST_INDEX = """
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE tablename = '{table}' AND indexdef LIKE '%USING gist ({column})%') THEN
+        CREATE INDEX {table}_{column}_gist ON {table} USING gist ({column});
+    END IF;
+END
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_vegetationtype'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ENSURE_GIST_INDEX.format(table='core_development', column='footprint'),
+                          migrations.RunSQL.noop),
+        migrations.RunSQL(ENSURE_GIST_INDEX.format(table='core_offset', column='polygon'),
+                          migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 10:20
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+ZOOM_LEVELS = (5, 8, 11)
+
+
+def backfill_sql(table, column):
+    """Simplifies the existing rows with the tolerance of a pixel at each zoom level"""
+    return 'UPDATE {} SET {}'.format(table, ', '.join(
+        '{column}_z{zoom} = ST_Multi(ST_SimplifyPreserveTopology({column}, {tolerance!r}))'.format(
+            column=column, zoom=zoom, tolerance=360.0 / (256 * 2 ** zoom))
+        for zoom in ZOOM_LEVELS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_spatial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='development',
+            name='footprint_z5',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='development',
+            name='footprint_z8',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='development',
+            name='footprint_z11',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='offset',
+            name='polygon_z5',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='offset',
+            name='polygon_z8',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='offset',
+            name='polygon_z11',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, editable=False, null=True, spatial_index=False, srid=4326),
+        ),
+        migrations.RunSQL(backfill_sql('core_development', 'footprint'), migrations.RunSQL.noop),
+        migrations.RunSQL(backfill_sql('core_offset', 'polygon'), migrations.RunSQL.noop),
+    ]
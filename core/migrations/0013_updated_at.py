@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_tableversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='biodiversity',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When this entry was last changed.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='development',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When this development was last changed.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='offset',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When this offset was last changed.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='permit',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When this permit was last changed.'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:00
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DevelopmentOffsetSummary',
+            fields=[
+                ('development', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='offset_summary', serialize=False, to='core.Development')),
+                ('total_loss', models.IntegerField(db_index=True, default=0, help_text='Hectares of biodiversity lost by the development.')),
+                ('total_gain', models.IntegerField(db_index=True, default=0, help_text="Hectares of biodiversity gained on the development's offsets.")),
+                ('ratio', models.FloatField(blank=True, db_index=True, help_text='Hectares gained per hectare lost, empty if no loss is recorded.', null=True)),
+                ('ecosystem_counts', django.contrib.postgres.fields.jsonb.JSONField(default=dict, help_text='The number of losses and gains of each ecosystem, e.g. {"Renosterveld": {"loss": 2, "gain": 1}}.')),
+            ],
+        ),
+    ]
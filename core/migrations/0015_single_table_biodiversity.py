@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 14:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Moves the losses and gains out of the multi-table inheritance child tables into core_biodiversity, with a kind
+    column telling them apart. Reversible, the child tables are recreated and filled back in. The child models still
+    have their development and offset fields until they are deleted, so the new columns on core_biodiversity are added
+    under other names and renamed once they are gone.
+    """
+
+    dependencies = [
+        ('core', '0014_developmentoffsetsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='biodiversity',
+            name='kind',
+            field=models.CharField(choices=[('L', 'Loss'), ('G', 'Gain')], default='L', help_text='Whether the biodiversity is lost by a development or gained on an offset.', max_length=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='biodiversity',
+            name='loss_development',
+            field=models.ForeignKey(blank=True, help_text='The relevant development, for losses.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='biodiversity_losses', to='core.Development'),
+        ),
+        migrations.AddField(
+            model_name='biodiversity',
+            name='gain_offset',
+            field=models.ForeignKey(blank=True, help_text="The relevant offset, for gains. Should only link to offsets of type 'hectares'.", null=True, on_delete=django.db.models.deletion.CASCADE, related_name='biodiversity_gains', to='core.Offset'),
+        ),
+        migrations.RunSQL(
+            sql=[
+                "UPDATE core_biodiversity AS b SET kind = 'L', loss_development_id = l.development_id "
+                "FROM core_biodiversityloss AS l WHERE l.biodiversity_ptr_id = b.id",
+                "UPDATE core_biodiversity AS b SET kind = 'G', gain_offset_id = g.offset_id "
+                "FROM core_biodiversitygain AS g WHERE g.biodiversity_ptr_id = b.id",
+            ],
+            reverse_sql=[
+                "INSERT INTO core_biodiversityloss (biodiversity_ptr_id, development_id) "
+                "SELECT id, loss_development_id FROM core_biodiversity WHERE kind = 'L'",
+                "INSERT INTO core_biodiversitygain (biodiversity_ptr_id, offset_id) "
+                "SELECT id, gain_offset_id FROM core_biodiversity WHERE kind = 'G'",
+            ],
+        ),
+        migrations.DeleteModel(
+            name='BiodiversityGain',
+        ),
+        migrations.DeleteModel(
+            name='BiodiversityLoss',
+        ),
+        migrations.RenameField(
+            model_name='biodiversity',
+            old_name='loss_development',
+            new_name='development',
+        ),
+        migrations.RenameField(
+            model_name='biodiversity',
+            old_name='gain_offset',
+            new_name='offset',
+        ),
+        migrations.CreateModel(
+            name='BiodiversityGain',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('core.biodiversity',),
+        ),
+        migrations.CreateModel(
+            name='BiodiversityLoss',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+            },
+            bases=('core.biodiversity',),
+        ),
+        migrations.AddIndex(
+            model_name='biodiversity',
+            index=models.Index(fields=['development', 'type'], name='core_biodiv_develop_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='biodiversity',
+            index=models.Index(fields=['offset', 'type'], name='core_biodiv_offset_type_idx'),
+        ),
+    ]
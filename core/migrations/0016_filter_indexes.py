@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 15:00
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_single_table_biodiversity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='development',
+            name='use',
+            field=models.CharField(choices=[('AG', 'Agriculture'), ('BU', 'Business'), ('CO', 'Commercial'), ('GO', 'Government'), ('GP', 'Government purposes'), ('IN', 'Industrial'), ('MI', 'Mining'), ('MU', 'Multi-use (public, residential, commercial)'), ('RC', 'Recreational'), ('RE', 'Residential'), ('TR', 'Transport'), ('UN', 'Unknown')], db_index=True, help_text='Choose all types of development that form part of the application.', max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='permit',
+            name='date_issued',
+            field=models.DateField(blank=True, db_index=True, help_text='The date this permit was issued.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='offset',
+            name='type',
+            field=models.CharField(blank=True, choices=[('HE', 'Hectares'), ('RE', 'Research'), ('RH', 'Rehabilitation'), ('FI', 'Financial compensation')], db_index=True, help_text='The type of offset.', max_length=2, null=True),
+        ),
+        migrations.AlterField(
+            model_name='offset',
+            name='duration',
+            field=models.CharField(choices=[('PE', 'Perpetuity'), ('US', 'Unspecified'), ('UN', 'Unknown'), ('LT', '< 20 years'), ('TF', 'Between 20 and 50 years'), ('HC', '> 50 years')], db_index=True, help_text='The length of time the offset should endure for. This does not make sense for certain options.', max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='offset',
+            name='offset_met',
+            field=models.CharField(choices=[('ME', 'Yes, this offset has been met'), ('LA', 'No, this offset has not been met and the time has lapsed, it is outstanding.'), ('IP', 'No, this offset has not yet been met but the development is still in progress.'), ('NU', 'No, this offset has not been met for reasons unknown.'), ('NO', 'No, this offset has not been met because there is no offset area available.'), ('UN', "We don't know if this offset has been met or not.")], db_index=True, help_text='The status of the offset requirement (whether it has been met or not).', max_length=2),
+        ),
+        migrations.AddIndex(
+            model_name='development',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['geo_info'], name='core_dev_geo_info_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='biodiversity',
+            index=models.Index(fields=['kind', 'type'], name='core_biodiv_kind_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='biodiversity',
+            index=models.Index(fields=['kind', 'name'], name='core_biodiv_kind_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='developmentoffsetsummary',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['ecosystem_counts'], name='core_summary_ecosystems_gin'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 16:00
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# The same vectors as core.search.VECTORS, for the rows which already exist
+FILL_PERMIT_VECTORS = """
+UPDATE core_permit SET search_vector =
+    setweight(to_tsvector('english'::regconfig, COALESCE(reference_no, '')), 'A') ||
+    setweight(to_tsvector('english'::regconfig, COALESCE(case_officer, '') || ' ' ||
+        COALESCE(environmental_consultancy, '') || ' ' || COALESCE(environmental_assessment_practitioner, '')), 'B') ||
+    setweight(to_tsvector('english'::regconfig, COALESCE(application_title, '')), 'B') ||
+    setweight(to_tsvector('english'::regconfig, COALESCE(activity_description, '')), 'C')
+"""
+FILL_DEVELOPMENT_VECTORS = """
+UPDATE core_development SET search_vector =
+    setweight(to_tsvector('english'::regconfig, COALESCE(code, '')), 'A') ||
+    setweight(to_tsvector('english'::regconfig, COALESCE(developer, '')), 'B') ||
+    setweight(to_tsvector('english'::regconfig, COALESCE(location_description, '')), 'C')
+"""
+
+# Django 1.11 can't declare operator classes on indexes
+TRIGRAM_INDEXES = [
+    ('core_permit', 'reference_no'),
+    ('core_permit', 'case_officer'),
+    ('core_permit', 'environmental_consultancy'),
+    ('core_development', 'code'),
+    ('core_development', 'developer'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_filter_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='development',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='permit',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(FILL_PERMIT_VECTORS, migrations.RunSQL.noop),
+        migrations.RunSQL(FILL_DEVELOPMENT_VECTORS, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='development',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='core_dev_search_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='permit',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='core_permit_search_gin'),
+        ),
+    ] + [
+        migrations.RunSQL('CREATE INDEX {table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)'.format(
+                              table=table, column=column),
+                          'DROP INDEX {table}_{column}_trgm'.format(table=table, column=column))
+        for table, column in TRIGRAM_INDEXES
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 18:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='development',
+            name='source_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the input rows and polygon this development was loaded from, see the load_input command.', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='offset',
+            name='source_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the input polygon and columns this offset was loaded from, see the load_input command.', max_length=64, null=True),
+        ),
+    ]
@@ -1,6 +1,9 @@
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import JSONField
-from core import services
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models import F
+from django.utils import timezone
 
 
 class PermitName(models.Model):
@@ -20,6 +23,14 @@ class PermitName(models.Model):
         unique_together = ('name', 'authority')
 
 
+class DevelopmentQuerySet(models.QuerySet):
+    def delete(self):
+        # See Development.delete
+        from core import signals
+        with signals.deleting(self.values_list('pk', flat=True)):
+            return super(DevelopmentQuerySet, self).delete()
+
+
 class Development(models.Model):
     """
     Developments are buildings or groups of buildings/constructions which are undertaken somewhere in South Africa.
@@ -51,17 +62,40 @@ class Development(models.Model):
         (TRANSPORT, 'Transport'),
         (UNKNOWN, 'Unknown'),
     )
-    use = models.CharField(max_length=2, choices=TYPE_CHOICES, help_text="Choose all types of development that form part of the application.")
+    use = models.CharField(max_length=2, choices=TYPE_CHOICES, db_index=True, help_text="Choose all types of development that form part of the application.")
 
     footprint = models.MultiPolygonField(help_text="Should be a .geojson file.", null=True, blank=True)
+    # Simplified copies of the footprint for overview maps, kept in sync on save (see core.geometry)
+    footprint_z5 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
+    footprint_z8 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
+    footprint_z11 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
     location_description = models.TextField(null=True, blank=True, help_text="A description of the locality of the development.")
     developer= models.CharField(max_length=100, null=True, blank=True, help_text="The name of the development company who applied for the permit?")
     code = models.CharField(max_length=200, null=True, blank=True, help_text="This is SANBI's ID code for this development.")
     start_date = models.DateField(null=True, blank=True, help_text="The day on which development is due to start.")
+    geo_info = JSONField(null=True, blank=True, help_text="The vegetation types intersecting the footprint, keyed by vegetation type name.")
+    updated_at = models.DateTimeField(auto_now=True, help_text="When this development was last changed.")
+    source_hash = models.CharField(max_length=64, null=True, blank=True, editable=False, help_text="SHA-256 of the input rows and polygon this development was loaded from, see the load_input command.")
+    # The code, developer and location description, kept up to date on save, see core.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = DevelopmentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['geo_info'], name='core_dev_geo_info_gin'),
+            GinIndex(fields=['search_vector'], name='core_dev_search_gin'),
+        ]
 
     def __str__(self):
         return self.code
 
+    def delete(self, *args, **kwargs):
+        # The cascaded deletes of its losses and gains mustn't recreate the summary the delete removes
+        from core import signals
+        with signals.deleting([self.pk]):
+            return super(Development, self).delete(*args, **kwargs)
+
 
 class Permit(models.Model):
     """
@@ -70,7 +104,7 @@ class Permit(models.Model):
     permit_name = models.ForeignKey(PermitName, on_delete=models.CASCADE)
     development = models.ForeignKey(Development, on_delete=models.CASCADE)
     reference_no = models.CharField(max_length=200, null=True, blank=True, help_text="The reference number for the permit.")
-    date_issued = models.DateField(null=True, blank=True, help_text="The date this permit was issued.")
+    date_issued = models.DateField(null=True, blank=True, db_index=True, help_text="The date this permit was issued.")
 
     case_officer = models.CharField(max_length=100, null=True, blank=True, help_text="The name of the case officer dealing with the permit.")
     application_title = models.CharField(max_length=500, null=True, blank=True, help_text="Should describe what the development is, e.g. 'Establishment of the Northern Golf Course Estate, Johannesburg Gauteng'.")
@@ -87,6 +121,14 @@ class Permit(models.Model):
         (OFFSET_REQUIREMENT_NOT_PUBLICISED, 'No, not publicised')
     )
     offset_requirement_stipulated = models.CharField(max_length=2, choices=OFFSET_REQUIREMENT_STIPULATED_CHOICES, help_text="Choose all types of development that form part of the application.")
+    updated_at = models.DateTimeField(auto_now=True, help_text="When this permit was last changed.")
+    # The reference number, people, consultancy, title and description, kept up to date on save, see core.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='core_permit_search_gin'),
+        ]
 
 
 class OffsetImplementationTime(models.Model):
@@ -124,9 +166,14 @@ class Offset(models.Model):
         (REHAB, 'Rehabilitation'),
         (FINANCIAL, 'Financial compensation')
     )
-    type = models.CharField(max_length=2, choices=TYPE_CHOICES, null=True, blank=True, help_text="The type of offset.")
+    type = models.CharField(max_length=2, choices=TYPE_CHOICES, null=True, blank=True, db_index=True, help_text="The type of offset.")
 
     polygon = models.MultiPolygonField(null=True, blank=True)
+    # Simplified copies of the polygon for overview maps, kept in sync on save (see core.geometry)
+    polygon_z5 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
+    polygon_z8 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
+    polygon_z11 = models.MultiPolygonField(null=True, blank=True, editable=False, spatial_index=False)
+
     PERPETUITY = 'PE'
     UNSPECIFIED = 'US'
     UNKNOWN = 'UN'
@@ -141,7 +188,7 @@ class Offset(models.Model):
         (MIDRANGE, 'Between 20 and 50 years'),
         (LONG, '> 50 years'),
     )
-    duration = models.CharField(max_length=2, choices=DURATION_CHOICES, help_text="The length of time the offset should endure for. This does not make sense for certain options.")
+    duration = models.CharField(max_length=2, choices=DURATION_CHOICES, db_index=True, help_text="The length of time the offset should endure for. This does not make sense for certain options.")
 
     MET = 'ME'
     NOT_MET_LAPSED = 'LA'
@@ -157,14 +204,27 @@ class Offset(models.Model):
         (NOT_MET_NO_OFFSET, 'No, this offset has not been met because there is no offset area available.'),
         (UNKNOWN, 'We don\'t know if this offset has been met or not.'),
     )
-    offset_met = models.CharField(max_length=1, choices=OFFSET_MET_CHOICES, help_text="The status of the offset requirement (whether it has been met or not).")
+    offset_met = models.CharField(max_length=2, choices=OFFSET_MET_CHOICES, db_index=True, help_text="The status of the offset requirement (whether it has been met or not).")
+    info = JSONField(null=True, blank=True, help_text="The vegetation types intersecting the offset, keyed by vegetation type name.")
+    updated_at = models.DateTimeField(auto_now=True, help_text="When this offset was last changed.")
+    source_hash = models.CharField(max_length=64, null=True, blank=True, editable=False, help_text="SHA-256 of the input polygon and columns this offset was loaded from, see the load_input command.")
 
 
 class Biodiversity(models.Model):
     """
     Every time a development occurs there is a loss of biodiversity. Sometimes this biodiversity loss is reflected in the
-    offset, sometimes not. This table will store the each piece of biodiversity lost for a development footprint.
+    offset, sometimes not. This table stores each piece of biodiversity lost by a development footprint, or gained on
+    an offset, in the one table so that listing and filtering them needs no joins. BiodiversityLoss and
+    BiodiversityGain are views onto either kind.
     """
+    LOSS = 'L'
+    GAIN = 'G'
+    KIND_CHOICES = (
+        (LOSS, 'Loss'),
+        (GAIN, 'Gain'),
+    )
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES, help_text="Whether the biodiversity is lost by a development or gained on an offset.")
+
     ECOSYSTEM = 'E'
     THREATENED_SP = 'T'
     TYPE_CHOICES = (
@@ -176,6 +236,29 @@ class Biodiversity(models.Model):
 
     # Optional fields sometimes not displayed (only for ecosystems)
     size = models.IntegerField(null=True, blank=True, help_text="This is the area in hectares relevant to this trigger (e.g. 20 ha of pristine renosterveld will be destroyed).")
+    updated_at = models.DateTimeField(auto_now=True, help_text="When this entry was last changed.")
+
+    development = models.ForeignKey(Development, null=True, blank=True, related_name='biodiversity_losses', help_text="The relevant development, for losses.")
+    offset = models.ForeignKey(Offset, null=True, blank=True, related_name='biodiversity_gains', help_text="The relevant offset, for gains. Should only link to offsets of type 'hectares'.")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['development', 'type'], name='core_biodiv_develop_type_idx'),
+            models.Index(fields=['offset', 'type'], name='core_biodiv_offset_type_idx'),
+            # The proxy models always filter on kind
+            models.Index(fields=['kind', 'type'], name='core_biodiv_kind_type_idx'),
+            models.Index(fields=['kind', 'name'], name='core_biodiv_kind_name_idx'),
+        ]
+
+
+class BiodiversityKindManager(models.Manager):
+    """Only returns the biodiversity of one kind"""
+    def __init__(self, kind):
+        super(BiodiversityKindManager, self).__init__()
+        self.kind = kind
+
+    def get_queryset(self):
+        return super(BiodiversityKindManager, self).get_queryset().filter(kind=self.kind)
 
 
 class BiodiversityLoss(Biodiversity):
@@ -183,14 +266,121 @@ class BiodiversityLoss(Biodiversity):
     Every time a development occurs there is a loss of biodiversity. Sometimes this biodiversity loss is reflected in the
     offset, sometimes not. This table will store the each piece of biodiversity lost for a development footprint.
     """
-    development = models.ForeignKey(Development, help_text="The relevant development.")
+    objects = BiodiversityKindManager(Biodiversity.LOSS)
+
+    class Meta:
+        proxy = True
+
+    def __init__(self, *args, **kwargs):
+        super(BiodiversityLoss, self).__init__(*args, **kwargs)
+        # Also covers bulk_create, and doesn't load the column when it was deferred
+        if not self.__dict__.get('kind'):
+            self.kind = Biodiversity.LOSS
 
 
 class BiodiversityGain(Biodiversity):
     """
-    Every time a development occurs there is a loss of biodiversity. Sometimes this biodiversity loss is reflected in the
-    offset, sometimes not. This table will store the each piece of biodiversity lost for a development footprint.
+    The biodiversity gained on an offset, which should make up for what its development lost.
+    """
+    objects = BiodiversityKindManager(Biodiversity.GAIN)
+
+    class Meta:
+        proxy = True
+
+    def __init__(self, *args, **kwargs):
+        super(BiodiversityGain, self).__init__(*args, **kwargs)
+        if not self.__dict__.get('kind'):
+            self.kind = Biodiversity.GAIN
+
+
+class StatisticCount(models.Model):
+    """
+    Precomputed value of a single bar in one of the dashboard charts returned by the statistics endpoint. Rows are kept
+    up to date by the signals in core.signals, which only recount the buckets touched by a write.
+    """
+    DEVELOPMENTS_PER_PERMIT = 'DP'
+    PERMITS_PER_YEAR = 'PY'
+    VEGETATION_TYPES = 'VT'
+    CHART_CHOICES = (
+        (DEVELOPMENTS_PER_PERMIT, 'Number of developments per permit'),
+        (PERMITS_PER_YEAR, 'Number of permits per year'),
+        (VEGETATION_TYPES, 'Number of vegetation types (developments)'),
+    )
+    chart = models.CharField(max_length=2, choices=CHART_CHOICES)
+    key = models.CharField(max_length=200, help_text="Identifies the bucket within the chart, e.g. the permit name id or the year.")
+    label = models.CharField(max_length=200)
+    value = models.IntegerField()
+
+    class Meta:
+        unique_together = ('chart', 'key')
+
+
+class DevelopmentOffsetSummary(models.Model):
+    """
+    Precomputed balance of the biodiversity a development loses against what is gained on its offsets, so that the
+    compliance dashboard doesn't have to join the losses, gains, offsets and permits itself. Rows are kept up to date
+    by the signals in core.signals, see core.summaries.
+    """
+    development = models.OneToOneField(Development, primary_key=True, related_name='offset_summary', on_delete=models.CASCADE)
+    total_loss = models.IntegerField(default=0, db_index=True, help_text="Hectares of biodiversity lost by the development.")
+    total_gain = models.IntegerField(default=0, db_index=True, help_text="Hectares of biodiversity gained on the development's offsets.")
+    ratio = models.FloatField(null=True, blank=True, db_index=True, help_text="Hectares gained per hectare lost, empty if no loss is recorded.")
+    ecosystem_counts = JSONField(default=dict, help_text="The number of losses and gains of each ecosystem, e.g. {\"Renosterveld\": {\"loss\": 2, \"gain\": 1}}.")
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['ecosystem_counts'], name='core_summary_ecosystems_gin'),
+        ]
+
+
+class AreaInfo(models.Model):
     """
-    offset = models.ForeignKey(Offset, help_text="The relevant offset, should only link to offsets of type 'hectares'.")
+    Cached results of the VegMap identify service, keyed on a hash of the normalized geometry, so that reloading
+    polygons we have already seen never goes over the network. See core.services.get_area_info.
+    """
+    key = models.CharField(max_length=64, primary_key=True, help_text="SHA-256 of the normalized 2D WKB of the geometry.")
+    info = JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class VegetationType(models.Model):
+    """
+    The 2012 VegMap vegetation type polygons. Development footprints and offset polygons are intersected with these in
+    the database to work out how many hectares of each vegetation type they cover, see core.services.compute_area_info.
+    """
+    name = models.CharField(max_length=200, db_index=True, help_text="The name of the vegetation type, e.g. Cape Flats Sand Fynbos.")
+    biome = models.CharField(max_length=100, null=True, blank=True)
+    polygon = models.MultiPolygonField()
+
+    def __str__(self):
+        return self.name
+
+
+class TableVersion(models.Model):
+    """
+    A counter per table which is bumped by signals whenever rows in the table change, so that anything cached from the
+    table (e.g. map tiles) can be invalidated without having to look at the rows themselves.
+    """
+    table = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '{} v{}'.format(self.table, self.version)
 
+    @classmethod
+    def bump(cls, *model_classes):
+        # Proxy models share their concrete model's table, and its version
+        for table in sorted(set(model._meta.db_table for model in model_classes)):
+            if not cls.objects.filter(table=table).update(version=F('version') + 1, updated_at=timezone.now()):
+                cls.objects.get_or_create(table=table, defaults={'version': 1})
 
+    @classmethod
+    def get_versions(cls, *model_classes):
+        """Returns the TableVersion of each model's table, keyed on the model, in one query"""
+        tables = {model._meta.db_table: model for model in model_classes}
+        versions = {model: cls(table=table) for table, model in tables.items()}
+        for table_version in cls.objects.filter(table__in=list(tables)):
+            versions[tables[table_version.table]] = table_version
+        return versions
@@ -0,0 +1,28 @@
+from collections import OrderedDict
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class IdCursorPagination(CursorPagination):
+    """Keyset pagination on the primary key, so fetching a deep page costs the same as fetching the first one"""
+    ordering = 'id'
+
+
+class SortablePagination(PageNumberPagination):
+    """
+    Page numbers for endpoints which clients sort on columns that can be null, which cursors can't page through. Only
+    use it for small tables.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class GeoJsonCursorPagination(IdCursorPagination):
+    """Cursor pagination which keeps the pages of the geo endpoints valid GeoJSON FeatureCollections"""
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('type', 'FeatureCollection'),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('features', data['features'])
+        ]))
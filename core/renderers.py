@@ -0,0 +1,121 @@
+"""
+Compact binary export of the geo endpoints for analysts loading whole layers into GeoPandas. The features are written
+as an Apache Arrow IPC stream, with the geometries as WKB and GeoParquet style "geo" metadata, batch by batch straight
+from a server side cursor.
+"""
+import json
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+from django.db.models import BinaryField, F, Func, TextField
+from django.db.models.functions import Cast
+import pyarrow as pa
+from rest_framework.renderers import BaseRenderer
+
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Arrow types of the model fields, anything not listed is exported as a string
+ARROW_TYPES = (
+    (models.BooleanField, pa.bool_()),
+    (models.AutoField, pa.int32()),
+    (models.ForeignKey, pa.int32()),
+    (models.IntegerField, pa.int64()),
+    (models.FloatField, pa.float64()),
+    (models.DateTimeField, pa.timestamp('us')),
+    (models.DateField, pa.date32()),
+)
+
+
+class ArrowStreamRenderer(BaseRenderer):
+    """
+    Lets ?format=arrow through content negotiation. The export itself is streamed by the geo viewsets, which render
+    any other response, e.g. an error, with a JSON renderer instead (see views.ArrowExportMixin).
+    """
+    media_type = ARROW_MEDIA_TYPE
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        raise NotImplementedError('Arrow streams are written by stream_arrow, not rendered')
+
+
+class AsBinary(Func):
+    function = 'ST_AsBinary'
+
+    def __init__(self, expression, **extra):
+        extra.setdefault('output_field', BinaryField())
+        super(AsBinary, self).__init__(expression, **extra)
+
+
+def arrow_type(field):
+    for field_class, pa_type in ARROW_TYPES:
+        if isinstance(field, field_class):
+            return pa_type
+    return pa.string()
+
+
+class ChunkSink(object):
+    """File-like object collecting what the Arrow writer writes, so it can be handed on a chunk at a time"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_arrow(queryset, fields, geometry=None, batch_size=5000):
+    """
+    Yields an Arrow IPC stream of the given model fields of a queryset. geometry is the name of the geometry field or
+    annotation to write as WKB, or None to leave the geometry out. Rows are read as tuples from a server side cursor
+    and converted a batch at a time, JSON is cast to text in the database, so no dictionaries are built per feature.
+    """
+    names, types, columns, annotations = [], [], [], {}
+    for field in fields:
+        names.append(field.name)
+        types.append(arrow_type(field))
+        if isinstance(field, JSONField):
+            annotations[field.name + '_text'] = Cast(field.name, TextField())
+            columns.append(field.name + '_text')
+        else:
+            columns.append(field.attname)
+    metadata = {}
+    if geometry is not None:
+        annotations['geometry_wkb'] = AsBinary(F(geometry))
+        columns.append('geometry_wkb')
+        names.append('geometry')
+        types.append(pa.binary())
+        metadata['geo'] = json.dumps({'primary_column': 'geometry',
+                                      'columns': {'geometry': {'encoding': 'WKB', 'crs': 'EPSG:4326'}}})
+
+    schema = pa.schema([pa.field(name, pa_type) for name, pa_type in zip(names, types)])
+    if metadata:
+        schema = schema.add_metadata(metadata)
+    rows = queryset.annotate(**annotations).values_list(*columns).iterator()
+
+    sink = ChunkSink()
+    writer = pa.RecordBatchStreamWriter(pa.PythonFile(sink, mode='w'), schema)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            write_batch(writer, batch, schema)
+            batch = []
+            yield sink.take()
+    if batch:
+        write_batch(writer, batch, schema)
+    writer.close()
+    yield sink.take()
+
+
+def write_batch(writer, rows, schema):
+    arrays = [pa.array([bytes(value) if isinstance(value, memoryview) else value for value in column], type=field.type)
+              for column, field in zip(zip(*rows), schema)]
+    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema.names))
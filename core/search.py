@@ -0,0 +1,83 @@
+"""
+Full text search over permits and developments. Each has a stored, weighted search vector which is kept up to date on
+save, and the free text fields people search for by name or number also have trigram indexes for fuzzy matches.
+Matching, ranking and highlighting all happen in the one query per model.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db.models import F, Func, Q, TextField, Value
+from django.db.models.functions import Greatest
+from core import models
+
+CONFIG = 'english'
+
+VECTORS = {
+    models.Permit: (SearchVector('reference_no', weight='A', config=CONFIG) +
+                    SearchVector('case_officer', 'environmental_consultancy', 'environmental_assessment_practitioner',
+                                 weight='B', config=CONFIG) +
+                    SearchVector('application_title', weight='B', config=CONFIG) +
+                    SearchVector('activity_description', weight='C', config=CONFIG)),
+    models.Development: (SearchVector('code', weight='A', config=CONFIG) +
+                         SearchVector('developer', weight='B', config=CONFIG) +
+                         SearchVector('location_description', weight='C', config=CONFIG)),
+}
+
+# The fields with trigram indexes, and the fields the headline is taken from
+FUZZY_FIELDS = {
+    models.Permit: ('reference_no', 'case_officer', 'environmental_consultancy'),
+    models.Development: ('code', 'developer'),
+}
+HEADLINE_FIELDS = {
+    models.Permit: ('application_title', 'activity_description'),
+    models.Development: ('location_description',),
+}
+RESULT_FIELDS = {
+    models.Permit: ('id', 'development', 'reference_no', 'case_officer', 'environmental_consultancy',
+                    'application_title'),
+    models.Development: ('id', 'code', 'developer'),
+}
+
+
+class Headline(Func):
+    """ts_headline, the matching words of a text in context, marked up with <mark> tags"""
+    function = 'ts_headline'
+
+    def __init__(self, text, query, **extra):
+        extra.setdefault('output_field', TextField())
+        super(Headline, self).__init__(Value(CONFIG), text, query,
+                                       Value('StartSel=<mark>, StopSel=</mark>, MaxFragments=2'), **extra)
+
+
+class ConcatText(Func):
+    """The non null values of some text columns, separated by spaces"""
+    function = 'concat_ws'
+
+    def __init__(self, *fields, **extra):
+        extra.setdefault('output_field', TextField())
+        super(ConcatText, self).__init__(Value(' '), *[F(field) for field in fields], **extra)
+
+
+def refresh_vectors(model, pks=None):
+    """Recomputes the search vectors of some rows, or all of them, in a single UPDATE"""
+    queryset = model.objects.all()
+    if pks is not None:
+        queryset = queryset.filter(pk__in=pks)
+    return queryset.update(search_vector=VECTORS[model])
+
+
+def search(model, text, limit=20):
+    """
+    Returns the rows of the model best matching the text as dictionaries of RESULT_FIELDS, along with their rank and
+    a highlighted headline. Rows match on their search vector, or on a fuzzy match of one of the FUZZY_FIELDS.
+    """
+    query = SearchQuery(text, config=CONFIG)
+    matches = Q(search_vector=query)
+    similarities = []
+    for field in FUZZY_FIELDS[model]:
+        matches |= Q(**{field + '__trigram_similar': text})
+        similarities.append(TrigramSimilarity(field, text))
+    rank = SearchRank(F('search_vector'), query)
+    return list(model.objects.filter(matches)
+                .annotate(rank=Greatest(rank, *similarities),
+                          headline=Headline(ConcatText(*HEADLINE_FIELDS[model]), query))
+                .order_by('-rank', 'id')
+                .values(*RESULT_FIELDS[model] + ('rank', 'headline'))[:limit])
@@ -1,37 +1,127 @@
 from rest_framework import serializers
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
-from core import models
+from core import bulk, models
 from rest_framework.metadata import SimpleMetadata
 
 from collections import OrderedDict
+import hashlib
+from django.utils import translation
 from django.utils.encoding import force_text
 from rest_framework import serializers
 from rest_framework.utils.field_mapping import ClassLookupDict
 from rest_framework_gis.fields import GeometryField
 
 
-class PermitNameSerializer(serializers.HyperlinkedModelSerializer):
+def parse_field_list(value):
+    """Parses a comma separated list of field names from a query parameter"""
+    return set(name.strip() for name in (value or '').split(',') if name.strip())
+
+
+def include_geometry(request):
+    return request.query_params.get('geometry', 'true').lower() not in ('false', '0')
+
+
+class OmittedGeometryField(serializers.Field):
+    """Stands in for the geometry of a geo serializer when it is left out with ?geometry=false"""
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super(OmittedGeometryField, self).__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        return None
+
+    def to_representation(self, value):
+        return None
+
+
+class SparseFieldsMixin(object):
+    """
+    Narrows the fields a serializer returns with ?fields=id,code or ?omit=location_description, and leaves out the
+    geometry of geo serializers with ?geometry=false. The viewsets defer the columns which are no longer needed.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+
+        keep = parse_field_list(request.query_params.get('fields'))
+        omit = parse_field_list(request.query_params.get('omit'))
+        geo_field = getattr(self.Meta, 'geo_field', None)
+        # GeoJSON features always need an id and a geometry
+        required = set([geo_field, getattr(self.Meta, 'id_field', None)]) if geo_field else set()
+        for name in list(self.fields):
+            if name not in required and ((keep and name not in keep) or name in omit):
+                self.fields.pop(name)
+        if geo_field and not include_geometry(request):
+            self.fields[geo_field] = OmittedGeometryField()
+
+
+class SimplifiedGeometryField(GeometryField):
+    """
+    Geometry field which returns the simplified geometry the geo viewsets annotate for ?zoom= and ?tolerance=
+    requests, and the full geometry otherwise
+    """
+    def get_attribute(self, instance):
+        if hasattr(instance, 'simplified_geometry'):
+            return instance.simplified_geometry
+        return super(SimplifiedGeometryField, self).get_attribute(instance)
+
+
+class PermitNameSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.PermitName
         fields = ('id', 'url', 'name', 'authority')
 
 
-class BiodiversityLossSerializer(serializers.HyperlinkedModelSerializer):
+class BiodiversityLossSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    serializer_related_field = bulk.PreloadedRelatedField
+
     class Meta:
         model = models.BiodiversityLoss
         fields = ('id', 'url', 'type','name', 'size', 'development')
+        # Both kinds share the one table, so the column is nullable there
+        extra_kwargs = {'development': {'required': True, 'allow_null': False}}
+        list_serializer_class = bulk.BulkListSerializer
 
 
-class BiodiversityGainSerializer(serializers.HyperlinkedModelSerializer):
+class BiodiversityGainSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    serializer_related_field = bulk.PreloadedRelatedField
+
     class Meta:
         model = models.BiodiversityGain
         fields = ('id', 'url', 'type','name', 'size', 'offset')
+        extra_kwargs = {'offset': {'required': True, 'allow_null': False}}
+        list_serializer_class = bulk.BulkListSerializer
+
 
+class PermitSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    serializer_related_field = bulk.PreloadedRelatedField
 
-class PermitSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Permit
         fields = ('id', 'url', 'permit_name','development', 'case_officer', 'date_issued', 'reference_no')
+        list_serializer_class = bulk.BulkListSerializer
+
+
+class DevelopmentOffsetSummarySerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = models.DevelopmentOffsetSummary
+        fields = ('url', 'development', 'total_loss', 'total_gain', 'ratio', 'ecosystem_counts')
+
+
+def schema_version(model):
+    """
+    Fingerprint of a model's fields, their types, choices and help texts, which is everything the OPTIONS metadata is
+    built from besides the serializer itself
+    """
+    if model not in _schema_versions:
+        fields = [(field.name, field.deconstruct()[1:]) for field in model._meta.get_fields()
+                  if hasattr(field, 'deconstruct')]
+        _schema_versions[model] = hashlib.md5(repr(fields).encode('utf-8')).hexdigest()
+    return _schema_versions[model]
+
+_schema_versions = {}
 
 
 class GeoMetadata(SimpleMetadata):
@@ -64,6 +154,28 @@ class GeoMetadata(SimpleMetadata):
         PermitSerializer: 'foreign key - multi'
     })
 
+    # Field metadata per (serializer class, fields, model schema, language), shared by every request in the process
+    serializer_info = {}
+
+    def get_serializer_info(self, serializer):
+        """
+        The metadata of a serializer only depends on its class and model, so it is built once and then served from
+        memory. The front end asks for it for every form it renders.
+        """
+        serializer = getattr(serializer, 'child', serializer)
+        model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+        key = (type(serializer), tuple(serializer.fields), model and schema_version(model), translation.get_language())
+        if key not in self.serializer_info:
+            self.serializer_info[key] = super(GeoMetadata, self).get_serializer_info(serializer)
+        return self.serializer_info[key]
+
+    @classmethod
+    def warm(cls, registry):
+        """Builds the metadata of every viewset registered on a router which uses this class, e.g. at startup"""
+        for prefix, viewset, base_name in registry:
+            if getattr(viewset, 'metadata_class', None) is cls:
+                cls().get_serializer_info(viewset.serializer_class(context={}))
+
     def get_field_info(self, field):
         """
         Given an instance of a serializer field, return a dictionary
@@ -87,14 +199,18 @@ class GeoMetadata(SimpleMetadata):
         return field_info
 
 
-class DevelopmentSerializer(serializers.HyperlinkedModelSerializer):
+class DevelopmentSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    serializer_related_field = bulk.PreloadedRelatedField
+
     class Meta:
         model = models.Development
         fields = ('id', 'url',  'use', 'get_use_display', 'location_description', 'code')
+        list_serializer_class = bulk.BulkListSerializer
 
 
-class DevelopmentGeoSerializer(GeoFeatureModelSerializer):
+class DevelopmentGeoSerializer(SparseFieldsMixin, GeoFeatureModelSerializer):
     #geo_info = serializers.JSONField()
+    footprint = SimplifiedGeometryField(required=False, allow_null=True)
 
     class Meta:
         model = models.Development
@@ -102,14 +218,15 @@ class DevelopmentGeoSerializer(GeoFeatureModelSerializer):
         fields = ('id', 'url',  'use', 'get_use_display', 'location_description', 'code')
 
 
-class ImplementationTimeSerializer(serializers.HyperlinkedModelSerializer):
+class ImplementationTimeSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.OffsetImplementationTime
         fields = ('id', 'name', 'url')
 
 
-class OffsetGeoSerializer(GeoFeatureModelSerializer):
+class OffsetGeoSerializer(SparseFieldsMixin, GeoFeatureModelSerializer):
     info = serializers.JSONField()
+    polygon = SimplifiedGeometryField(required=False, allow_null=True)
 
     class Meta:
         model = models.Offset
@@ -117,9 +234,11 @@ class OffsetGeoSerializer(GeoFeatureModelSerializer):
         fields = ('id', 'url', 'permit', 'type', 'get_type_display', 'duration', 'implementation_times', 'info')
 
 
-class OffsetSerializer(serializers.HyperlinkedModelSerializer):
+class OffsetSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    serializer_related_field = bulk.PreloadedRelatedField
     info = serializers.JSONField()
 
     class Meta:
         model = models.Offset
         fields = ('id', 'url', 'permit', 'type', 'get_type_display', 'duration', 'implementation_times', 'info')
+        list_serializer_class = bulk.BulkListSerializer
@@ -1,36 +1,267 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import hashlib
+from django.conf import settings
+from django.contrib.gis.geos import WKBWriter
+from django.db import connection, transaction
+from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from core import models, statistics
 
-def get_area_info(polygon):
-    url = 'http://bgismaps.sanbi.org/arcgis/rest/services/2012VegMap/MapServer/identify'
-    coordinates = polygon.tuple
-    coordinates_str = str({"rings":  coordinates})\
-        .replace('(', '[')\
-        .replace(')', ']')\
-        .replace('],],]}', ']]}')\
-        .replace(']],]}', ']]}')\
-        .replace(': [[[[', ': [[[')
-    params = {
-        'geometry': coordinates_str,
-        'geometryType': 'esriGeometryPolygon',
-        'tolerance': 0,
-        'mapExtent': '-104,35.6,-94.32,41',
-        'imageDisplay': '600,550,96',
-        'returnGeometry': False,
-        'returnZ': False,
-        'returnM': False,
-        'f': 'json'
-    }
-    response = requests.post(url, data=params)
-    results = response.json()
-    info = {}
-
-    try:
-        for item in results['results']:
+# Hit/miss counters for the area info cache, for the life of the process
+cache_stats = Counter()
+
+
+class AreaInfoError(Exception):
+    """Raised when the VegMap identify service could not give us the vegetation types for a polygon"""
+    def __init__(self, message, status_code=None, response=None):
+        super(AreaInfoError, self).__init__(message)
+        self.status_code = status_code
+        self.response = response
+
+
+class VegMapClient(object):
+    """
+    Client for the VegMap identify service. Connections are kept alive in a pool shared by a bounded set of worker
+    threads, and failed requests are retried with exponential backoff.
+    """
+    def __init__(self, url=None, workers=None, retries=None, backoff=None, timeout=None):
+        self.url = url or settings.VEGMAP_IDENTIFY_URL
+        self.workers = workers or settings.VEGMAP_WORKERS
+        self.timeout = timeout or settings.VEGMAP_TIMEOUT
+        retry = Retry(total=settings.VEGMAP_RETRIES if retries is None else retries,
+                      backoff_factor=settings.VEGMAP_BACKOFF if backoff is None else backoff,
+                      status_forcelist=(500, 502, 503, 504),
+                      method_whitelist=frozenset(['POST']))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def identify(self, polygon):
+        """Returns the vegetation types a polygon intersects, raising AreaInfoError if the service fails"""
+        coordinates = polygon.tuple
+        coordinates_str = str({"rings":  coordinates})\
+            .replace('(', '[')\
+            .replace(')', ']')\
+            .replace('],],]}', ']]}')\
+            .replace(']],]}', ']]}')\
+            .replace(': [[[[', ': [[[')
+        params = {
+            'geometry': coordinates_str,
+            'geometryType': 'esriGeometryPolygon',
+            'tolerance': 0,
+            'mapExtent': '-104,35.6,-94.32,41',
+            'imageDisplay': '600,550,96',
+            'returnGeometry': False,
+            'returnZ': False,
+            'returnM': False,
+            'f': 'json'
+        }
+        try:
+            response = self.session.post(self.url, data=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise AreaInfoError('Request to the identify service failed: {}'.format(e))
+        if response.status_code != 200:
+            raise AreaInfoError('Identify service returned HTTP {}'.format(response.status_code),
+                                status_code=response.status_code, response=response.text)
+
+        try:
+            results = response.json()['results']
+        except (ValueError, KeyError):
+            raise AreaInfoError('Unexpected response from the identify service', status_code=response.status_code,
+                                response=response.text)
+
+        info = {}
+        for item in results:
             info[item['value']] = {
                 "area": 5,
                 "status": "to be retrieved",
                 "type": item['layerName']
             }
-    except:
-        import pdb; pdb.set_trace()
+        return info
+
+    def identify_many(self, polygons):
+        """
+        Looks up a batch of polygons concurrently. Returns a list in the same order as the polygons, containing the
+        info for each polygon or the AreaInfoError it failed with.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(self._identify_or_error, polygons))
+
+    def _identify_or_error(self, polygon):
+        try:
+            return self.identify(polygon)
+        except AreaInfoError as e:
+            return e
+
+
+_client = None
+
+
+def get_client():
+    """The shared client, created on first use so its connection pool is reused across lookups"""
+    global _client
+    if _client is None:
+        _client = VegMapClient()
+    return _client
+
+
+def get_area_info(polygon):
+    """
+    Returns the vegetation types a polygon intersects, from the area info cache if we have seen this geometry before
+    and from the VegMap identify service otherwise. Raises AreaInfoError if the lookup fails.
+    """
+    info = get_area_info_many([polygon])[0]
+    if isinstance(info, AreaInfoError):
+        raise info
     return info
+
+
+def get_area_info_many(polygons):
+    """
+    Batch version of get_area_info. Cached polygons are read in one query and the rest are looked up concurrently.
+    Returns a list in the same order as the polygons, containing the info or the AreaInfoError for each polygon.
+    """
+    results, used, fresh = lookup_area_info_many(polygons)
+    record_area_info(used, fresh)
+    return results
+
+
+def lookup_area_info_many(polygons, pending=None):
+    """
+    get_area_info_many without writing to the cache, for processes which leave the writes to another one. pending maps
+    keys to info the writer has fetched but not committed to the cache yet, and is checked for the keys the cache
+    doesn't have. Returns the results, the keys of the cached entries used and a dictionary of the info fetched from
+    the identify service by key, which record_area_info writes.
+    """
+    keys = [geometry_key(polygon) for polygon in polygons]
+    found = get_cached_area_info(keys, touch=False)
+    used = list(found)
+
+    missing = OrderedDict()
+    for key, polygon in zip(keys, polygons):
+        if key not in found and key not in missing and pending is not None:
+            info = pending.get(key)
+            if info is not None:
+                found[key] = info
+        if key in found:
+            cache_stats['hits'] += 1
+        elif key not in missing:
+            cache_stats['misses'] += 1
+            missing[key] = polygon
+
+    fresh = OrderedDict()
+    for key, info in zip(missing, get_client().identify_many(list(missing.values()))):
+        if isinstance(info, AreaInfoError):
+            cache_stats['failures'] += 1
+        else:
+            fresh[key] = info
+        found[key] = info
+    return [found[key] for key in keys], used, fresh
+
+
+def record_area_info(used, fresh):
+    """Marks the cached entries used by lookup_area_info_many as just used, and caches the info it fetched"""
+    if used:
+        models.AreaInfo.objects.filter(key__in=used).update(last_used=timezone.now())
+    for key, info in fresh.items():
+        cache_area_info(key, info)
+
+
+def identify_area_info(polygon):
+    """Looks a polygon up in the identify service, skipping the cache"""
+    return get_client().identify(polygon)
+
+
+def geometry_key(polygon):
+    """
+    The cache key for a geometry: a hash of its normalized 2D WKB in WGS84, so the same shape gives the same key
+    whatever its starting vertex, ring order or Z values
+    """
+    geometry = polygon.clone()
+    if geometry.srid and geometry.srid != 4326:
+        geometry.transform(4326)
+    geometry.normalize()
+    return hashlib.sha256(bytes(WKBWriter(dim=2).write(geometry))).hexdigest()
+
+
+def get_cached_area_info(keys, touch=True):
+    """
+    Returns a dictionary of the cached info for the keys which are present and younger than AREA_INFO_CACHE_TTL.
+    Unless touch is False the entries found are marked as just used, so purge_area_info_cache keeps them.
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=settings.AREA_INFO_CACHE_TTL)
+    cached = dict(models.AreaInfo.objects.filter(key__in=keys, created__gt=expired).values_list('key', 'info'))
+    if cached and touch:
+        models.AreaInfo.objects.filter(key__in=list(cached)).update(last_used=now)
+    return cached
+
+
+def cache_area_info(key, info):
+    models.AreaInfo.objects.update_or_create(key=key, defaults={'info': info, 'created': timezone.now()})
+    cache_stats['stores'] += 1
+    if cache_stats['stores'] % 100 == 0:
+        purge_area_info_cache()
+
+
+def purge_area_info_cache():
+    """
+    Removes expired entries, and then the least recently used entries over AREA_INFO_CACHE_MAX_ENTRIES.
+    Returns the number of entries removed.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.AREA_INFO_CACHE_TTL)
+    removed, _ = models.AreaInfo.objects.filter(created__lte=expired).delete()
+    overflow = models.AreaInfo.objects.order_by('-last_used')\
+        .values_list('key', flat=True)[settings.AREA_INFO_CACHE_MAX_ENTRIES:]
+    overflow_removed, _ = models.AreaInfo.objects.filter(key__in=list(overflow)).delete()
+    return removed + overflow_removed
+
+
+AREA_INFO_SQL = """
+UPDATE {table} AS target SET {info} = computed.info
+FROM (
+    SELECT id, COALESCE(
+        jsonb_object_agg(name, jsonb_build_object('area', hectares, 'status', 'calculated', 'type', biome))
+            FILTER (WHERE name IS NOT NULL),
+        '{{}}'::jsonb) AS info
+    FROM (
+        SELECT feature.id, vegetation.name, MAX(vegetation.biome) AS biome,
+            ROUND((SUM(ST_Area(ST_Intersection(
+                CASE WHEN ST_IsValid(feature.{geometry}) THEN feature.{geometry} ELSE ST_MakeValid(feature.{geometry}) END,
+                CASE WHEN ST_IsValid(vegetation.polygon) THEN vegetation.polygon ELSE ST_MakeValid(vegetation.polygon) END
+            )::geography)) / 10000)::numeric, 2) AS hectares
+        FROM {table} AS feature
+        LEFT JOIN {vegetation} AS vegetation ON ST_Intersects(feature.{geometry}, vegetation.polygon)
+        WHERE feature.{geometry} IS NOT NULL
+        GROUP BY feature.id, vegetation.name
+    ) AS areas
+    GROUP BY id
+) AS computed
+WHERE target.id = computed.id
+"""
+
+
+def compute_area_info():
+    """
+    Fills in Development.geo_info and Offset.info with the hectares of each vegetation type they cover, by intersecting
+    them with the VegetationType polygons. This runs one set-based statement per table, using the GiST indexes, rather
+    than a lookup per polygon. Invalid polygons, e.g. self-intersecting ones drawn by hand, are repaired with
+    ST_MakeValid before intersecting, as ST_Intersection would otherwise fail the whole statement on a single one.
+    Returns the number of developments and offsets updated.
+    """
+    updated = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model, geometry, info in ((models.Development, 'footprint', 'geo_info'), (models.Offset, 'polygon', 'info')):
+            cursor.execute(AREA_INFO_SQL.format(table=model._meta.db_table, info=info, geometry=geometry,
+                                                vegetation=models.VegetationType._meta.db_table))
+            updated[model._meta.model_name] = cursor.rowcount
+
+        # The update goes around the model signals, so recount the vegetation chart and invalidate the caches
+        statistics.refresh(models.StatisticCount.VEGETATION_TYPES)
+        models.TableVersion.bump(models.Development, models.Offset)
+    return updated
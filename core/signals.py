@@ -0,0 +1,224 @@
+"""
+Model signal handlers which keep the precomputed summaries in sync with the data they are derived from.
+"""
+from contextlib import contextmanager
+import threading
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from core import geometry, models, search, statistics, summaries
+
+_state = threading.local()
+
+
+@contextmanager
+def suspended():
+    """
+    Skips the summary updates for the duration of a bulk load. The caller is responsible for rebuilding the summaries
+    once it is done. Nested uses leave the updates off until the outermost one ends.
+    """
+    previous = is_suspended()
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = previous
+
+
+def is_suspended():
+    return getattr(_state, 'suspended', False)
+
+
+def permit_buckets(permit):
+    """The statistic buckets a permit is counted in"""
+    buckets = {models.StatisticCount.DEVELOPMENTS_PER_PERMIT: {permit.permit_name_id}}
+    if permit.date_issued:
+        buckets[models.StatisticCount.PERMITS_PER_YEAR] = {permit.date_issued.year}
+    return buckets
+
+
+def development_buckets(development):
+    """The statistic buckets a development is counted in"""
+    geo_info = development.geo_info if isinstance(development.geo_info, dict) else {}
+    return {models.StatisticCount.VEGETATION_TYPES: set(geo_info)}
+
+
+def refresh_buckets(*bucket_sets):
+    """Merges the buckets affected by a write and recounts them"""
+    if is_suspended():
+        return
+    merged = {}
+    for buckets in bucket_sets:
+        for chart, keys in buckets.items():
+            merged.setdefault(chart, set()).update(keys)
+    for chart, keys in merged.items():
+        statistics.refresh(chart, keys)
+
+
+def previous_buckets(sender, instance, get_buckets, fields):
+    """Looks up the buckets the stored version of an instance was counted in, so moves between buckets are caught"""
+    if instance.pk is None or is_suspended():
+        return {}
+    previous = sender.objects.filter(pk=instance.pk).only(*fields).first()
+    return get_buckets(previous) if previous else {}
+
+
+@receiver(pre_save, sender=models.Permit)
+def remember_permit_buckets(sender, instance, **kwargs):
+    instance._previous_buckets = previous_buckets(sender, instance, permit_buckets, ['permit_name', 'date_issued'])
+
+
+@receiver(pre_save, sender=models.Development)
+def remember_development_buckets(sender, instance, **kwargs):
+    instance._previous_buckets = previous_buckets(sender, instance, development_buckets, ['geo_info'])
+
+
+@receiver(post_save, sender=models.Permit)
+def update_permit_statistics(sender, instance, **kwargs):
+    refresh_buckets(getattr(instance, '_previous_buckets', {}), permit_buckets(instance))
+
+
+@receiver(post_save, sender=models.Development)
+def update_development_statistics(sender, instance, **kwargs):
+    refresh_buckets(getattr(instance, '_previous_buckets', {}), development_buckets(instance))
+
+
+@receiver(post_delete, sender=models.Permit)
+def remove_permit_statistics(sender, instance, **kwargs):
+    refresh_buckets(permit_buckets(instance))
+
+
+@receiver(post_delete, sender=models.Development)
+def remove_development_statistics(sender, instance, **kwargs):
+    refresh_buckets(development_buckets(instance))
+
+
+@receiver(post_save, sender=models.PermitName)
+def update_permit_name_label(sender, instance, created, **kwargs):
+    if not created and not is_suspended():
+        statistics.refresh(models.StatisticCount.DEVELOPMENTS_PER_PERMIT, [instance.pk])
+
+
+@receiver(pre_save, sender=models.Development)
+@receiver(pre_save, sender=models.Offset)
+def update_simplified_geometries(sender, instance, **kwargs):
+    geometry.set_simplified(instance)
+
+
+@receiver(post_save, sender=models.Development)
+@receiver(post_save, sender=models.Permit)
+def update_search_vector(sender, instance, **kwargs):
+    if not is_suspended():
+        search.refresh_vectors(sender, [instance.pk])
+
+
+def previous_value(sender, instance, field):
+    """The stored value of a foreign key of an instance which is about to be saved"""
+    if instance.pk is None or is_suspended():
+        return None
+    return sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+def refresh_summaries(development_ids):
+    """Recomputes the offset summaries of the given developments, other than ones which are being deleted"""
+    if is_suspended():
+        return
+    summaries.refresh(set(development_ids) - getattr(_state, 'deleting', frozenset()) - {None})
+
+
+def offset_developments(*offset_ids):
+    return models.Permit.objects.filter(offset__in=offset_ids).values_list('development', flat=True)
+
+
+@contextmanager
+def deleting(development_ids):
+    """
+    Marks developments as being deleted for the duration of their delete (see Development.delete), whether it
+    succeeds or not, so the cascaded deletes of their losses and gains don't recreate their summaries
+    """
+    previous = getattr(_state, 'deleting', frozenset())
+    _state.deleting = previous | set(development_ids)
+    try:
+        yield
+    finally:
+        _state.deleting = previous
+
+
+@receiver(post_save, sender=models.Development)
+def create_offset_summary(sender, instance, created, **kwargs):
+    if created:
+        refresh_summaries([instance.pk])
+
+
+# Saves send the signals for the proxy class used, deletes cascading from developments and offsets for Biodiversity
+BIODIVERSITY_MODELS = (models.Biodiversity, models.BiodiversityLoss, models.BiodiversityGain)
+
+
+def remember_biodiversity_owner(sender, instance, **kwargs):
+    previous = None
+    if instance.pk is not None and not is_suspended():
+        previous = models.Biodiversity.objects.filter(pk=instance.pk).values_list('development', 'offset').first()
+    instance._previous_owner = previous or (None, None)
+
+
+def update_biodiversity_summary(sender, instance, **kwargs):
+    if is_suspended():
+        return
+    previous_development, previous_offset = getattr(instance, '_previous_owner', (None, None))
+    developments = {instance.development_id, previous_development}
+    offsets = set([instance.offset_id, previous_offset]) - {None}
+    if offsets:
+        developments.update(offset_developments(*offsets))
+    refresh_summaries(developments)
+
+
+for model in BIODIVERSITY_MODELS:
+    pre_save.connect(remember_biodiversity_owner, sender=model)
+    post_save.connect(update_biodiversity_summary, sender=model)
+    post_delete.connect(update_biodiversity_summary, sender=model)
+
+
+@receiver(pre_save, sender=models.Offset)
+def remember_offset_permit(sender, instance, **kwargs):
+    instance._previous_permit = previous_value(sender, instance, 'permit')
+
+
+@receiver(post_save, sender=models.Offset)
+def update_offset_summary(sender, instance, created, **kwargs):
+    # Gains only move between developments when an existing offset moves to another permit, deletes cascade to them
+    previous = getattr(instance, '_previous_permit', None)
+    if previous is not None and previous != instance.permit_id and not is_suspended():
+        refresh_summaries(models.Permit.objects.filter(pk__in=[previous, instance.permit_id])
+                          .values_list('development', flat=True))
+
+
+@receiver(pre_save, sender=models.Permit)
+def remember_permit_development(sender, instance, **kwargs):
+    instance._previous_development = previous_value(sender, instance, 'development')
+
+
+@receiver(post_save, sender=models.Permit)
+def update_permit_summary(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_development', None)
+    if previous is not None and previous != instance.development_id:
+        refresh_summaries([previous, instance.development_id])
+
+
+# The tables the API serves, whose TableVersion invalidates the tiles, ETags and cached list pages built from them
+VERSIONED_MODELS = (models.Development, models.Permit, models.PermitName, models.Offset,
+                    models.OffsetImplementationTime) + BIODIVERSITY_MODELS
+
+
+def bump_table_version(sender, **kwargs):
+    if not is_suspended():
+        models.TableVersion.bump(sender)
+
+
+for model in VERSIONED_MODELS:
+    post_save.connect(bump_table_version, sender=model)
+    post_delete.connect(bump_table_version, sender=model)
+
+
+@receiver(m2m_changed, sender=models.Offset.implementation_times.through)
+def bump_offset_version(sender, action, **kwargs):
+    if action.startswith('post_') and not is_suspended():
+        models.TableVersion.bump(models.Offset)
@@ -0,0 +1,109 @@
+"""
+Precomputed statistics for the dashboard charts. The counts are stored in StatisticCount so that the statistics
+endpoint reads a single small table, and writes to the underlying tables only recount the buckets they affect.
+"""
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.functions import ExtractYear
+from core import models
+
+CHART_AXES = {
+    models.StatisticCount.DEVELOPMENTS_PER_PERMIT: {'x_axis': 'Permits',
+                                                    'y_axis': 'Number of developments',
+                                                    'wide_graph': False},
+    models.StatisticCount.PERMITS_PER_YEAR: {'x_axis': 'Years',
+                                             'y_axis': 'Number of developments',
+                                             'wide_graph': False},
+    models.StatisticCount.VEGETATION_TYPES: {'x_axis': 'Vegetation types',
+                                             'y_axis': 'Number of developments',
+                                             'wide_graph': True},
+}
+
+
+def count_developments_per_permit(keys=None):
+    """Returns (key, label, value) tuples counting the developments which hold each type of permit"""
+    permits = models.Permit.objects.values('permit_name', 'permit_name__name')\
+        .annotate(total=Count('development', distinct=True))
+    if keys is not None:
+        permits = permits.filter(permit_name__in=keys)
+    return [(permit['permit_name'], permit['permit_name__name'], permit['total']) for permit in permits]
+
+
+def count_permits_per_year(keys=None):
+    """Returns (key, label, value) tuples counting the permits issued in each year"""
+    years = models.Permit.objects.filter(date_issued__isnull=False)\
+        .annotate(year=ExtractYear('date_issued')).values('year').annotate(total=Count('id'))
+    if keys is not None:
+        years = years.filter(year__in=keys)
+    return [(year['year'], year['year'], year['total']) for year in years]
+
+
+def count_vegetation_types(keys=None):
+    """Returns (key, label, value) tuples counting the developments which intersect each vegetation type"""
+    sql = 'SELECT veg_type, COUNT(*) FROM {table}, jsonb_object_keys({table}.geo_info) AS veg_type ' \
+          'WHERE jsonb_typeof({table}.geo_info) = %s'.format(table=models.Development._meta.db_table)
+    params = ['object']
+    if keys is not None:
+        sql += ' AND veg_type = ANY(%s)'
+        params.append(list(keys))
+    # jsonb_object_keys is a set returning function, so it has to be joined laterally rather than annotated
+    with connection.cursor() as cursor:
+        cursor.execute(sql + ' GROUP BY veg_type', params)
+        return [(veg_type, veg_type, total) for veg_type, total in cursor.fetchall()]
+
+
+COUNTERS = {
+    models.StatisticCount.DEVELOPMENTS_PER_PERMIT: count_developments_per_permit,
+    models.StatisticCount.PERMITS_PER_YEAR: count_permits_per_year,
+    models.StatisticCount.VEGETATION_TYPES: count_vegetation_types,
+}
+
+
+def refresh(chart, keys=None):
+    """
+    Recounts the given buckets of a chart, or the whole chart if no keys are given. Buckets which no longer have
+    anything in them are removed.
+    """
+    if keys is not None:
+        keys = set(keys)
+        if not keys:
+            return
+    with transaction.atomic():
+        # Concurrent writes to the same chart would both delete and then both insert its buckets, so they take turns.
+        # The lock is held until the transaction commits, and the counts are taken once it is held so they see the
+        # other transaction's rows.
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', ['statistics:' + chart])
+        counts = COUNTERS[chart](keys)
+        stale = models.StatisticCount.objects.filter(chart=chart)
+        if keys is not None:
+            stale = stale.filter(key__in=[str(key) for key in keys])
+        stale.delete()
+        models.StatisticCount.objects.bulk_create([
+            models.StatisticCount(chart=chart, key=str(key), label=str(label), value=value)
+            for key, label, value in counts if value
+        ])
+        models.TableVersion.bump(models.StatisticCount)
+
+
+def rebuild():
+    """Recounts every chart from scratch, used after bulk loads which bypass the model signals"""
+    for chart in COUNTERS:
+        refresh(chart)
+
+
+def get_charts():
+    """Returns the charts in the format expected by the dashboard"""
+    charts = {}
+    for chart, title in models.StatisticCount.CHART_CHOICES:
+        charts[chart] = dict(CHART_AXES[chart], title=title, data=[])
+
+    for count in models.StatisticCount.objects.all():
+        label = int(count.label) if count.chart == models.StatisticCount.PERMITS_PER_YEAR else count.label
+        charts[count.chart]['data'].append({'label': label, 'value': count.value})
+
+    response = {}
+    for chart in charts.values():
+        chart['data'] = sorted(chart['data'], key=lambda k: k['label'])
+        response[chart.pop('title')] = chart
+    return response
@@ -0,0 +1,61 @@
+"""
+Precomputed offset balance of every development, see models.DevelopmentOffsetSummary. Writes to the losses, gains,
+offsets and permits only recompute the developments they affect.
+"""
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from core import models
+
+
+def balances(development_ids=None):
+    """Returns {development id: (total loss, total gain, ecosystem counts)} from two grouped queries"""
+    sides = (
+        ('loss', 'development', models.BiodiversityLoss.objects.all()),
+        ('gain', 'offset__permit__development', models.BiodiversityGain.objects.all()),
+    )
+    results = {}
+    for side, development, entries in sides:
+        if development_ids is not None:
+            entries = entries.filter(**{development + '__in': development_ids})
+        for row in entries.values(development, 'type', 'name').annotate(hectares=Sum('size'), count=Count('pk')):
+            balance = results.setdefault(row[development], [0, 0, {}])
+            balance[0 if side == 'loss' else 1] += row['hectares'] or 0
+            if row['type'] == models.Biodiversity.ECOSYSTEM and row['name']:
+                ecosystem = balance[2].setdefault(row['name'], {'loss': 0, 'gain': 0})
+                ecosystem[side] += row['count']
+    return results
+
+
+def refresh(development_ids=None):
+    """Recomputes the summaries of the given developments, or of every development if no ids are given"""
+    developments = models.Development.objects.all()
+    if development_ids is not None:
+        development_ids = set(development_ids)
+        if not development_ids:
+            return
+        developments = developments.filter(pk__in=development_ids)
+
+    with transaction.atomic():
+        # As in statistics.refresh, concurrent refreshes would both delete and then both insert the same summaries, so
+        # they take turns, and the balances are computed once the lock is held so they see the other transaction's rows
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', ['summaries:developments'])
+        computed = balances(development_ids)
+        summaries = []
+        for development_id in developments.values_list('pk', flat=True):
+            total_loss, total_gain, counts = computed.get(development_id, (0, 0, {}))
+            summaries.append(models.DevelopmentOffsetSummary(
+                development_id=development_id, total_loss=total_loss, total_gain=total_gain,
+                ratio=float(total_gain) / total_loss if total_loss else None, ecosystem_counts=counts))
+
+        stale = models.DevelopmentOffsetSummary.objects.all()
+        if development_ids is not None:
+            stale = stale.filter(development__in=development_ids)
+        stale.delete()
+        models.DevelopmentOffsetSummary.objects.bulk_create(summaries, batch_size=1000)
+        models.TableVersion.bump(models.DevelopmentOffsetSummary)
+
+
+def rebuild():
+    """Recomputes every summary from scratch, used after bulk loads which bypass the model signals"""
+    refresh()
@@ -1,3 +1,866 @@
-from django.test import TestCase
+import csv
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import io
+import os
+import re
+import tempfile
+import threading
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import pyarrow as pa
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core import checks, geometry, helpers, loaders, models, serializers, services, signals, statistics, summaries, tiles
+
+
+class StatisticsTests(TestCase):
+    """The statistics endpoint should read the precomputed counts, which the signals keep up to date."""
+
+    def create_developments(self, count):
+        permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        for i in range(count):
+            development = models.Development.objects.create(use=models.Development.MINING, code=str(i),
+                                                            geo_info={'Sand Fynbos': {}, 'Renosterveld': {}})
+            models.Permit.objects.create(permit_name=permit_name, development=development,
+                                         date_issued=date(2010 + i % 3, 1, 1),
+                                         offset_requirement_stipulated=models.Permit.OFFSET_REQUIREMENT_STIPULATED)
+
+    def get_statistics(self):
+        return self.client.get('/statistics', HTTP_ACCEPT='application/json')
+
+    def test_query_count_is_constant(self):
+        # The table versions for the ETag, then the counts
+        self.create_developments(2)
+        with self.assertNumQueries(2):
+            self.get_statistics()
+
+        self.create_developments(20)
+        with self.assertNumQueries(2):
+            self.get_statistics()
+
+    def test_counts(self):
+        self.create_developments(4)
+        data = self.get_statistics().json()
+
+        self.assertEqual(data['Number of developments per permit']['data'],
+                         [{'label': 'Environmental Impact Assessment', 'value': 4}])
+        self.assertEqual(data['Number of permits per year']['data'],
+                         [{'label': 2010, 'value': 2}, {'label': 2011, 'value': 1}, {'label': 2012, 'value': 1}])
+        self.assertEqual(data['Number of vegetation types (developments)']['data'],
+                         [{'label': 'Renosterveld', 'value': 4}, {'label': 'Sand Fynbos', 'value': 4}])
+
+    def test_counts_follow_updates_and_deletes(self):
+        self.create_developments(3)
+        permit = models.Permit.objects.get(development__code='0')
+        permit.date_issued = date(2015, 6, 1)
+        permit.save()
+        development = models.Development.objects.get(code='1')
+        development.geo_info = {'Renosterveld': {}}
+        development.save()
+        models.Development.objects.get(code='2').delete()
+        data = self.get_statistics().json()
+
+        self.assertEqual(data['Number of developments per permit']['data'],
+                         [{'label': 'Environmental Impact Assessment', 'value': 2}])
+        self.assertEqual(data['Number of permits per year']['data'],
+                         [{'label': 2011, 'value': 1}, {'label': 2015, 'value': 1}])
+        self.assertEqual(data['Number of vegetation types (developments)']['data'],
+                         [{'label': 'Renosterveld', 'value': 2}, {'label': 'Sand Fynbos', 'value': 1}])
+
+    def test_rebuild_matches_incremental_counts(self):
+        self.create_developments(5)
+        incremental = self.get_statistics().json()
+        statistics.rebuild()
+        self.assertEqual(self.get_statistics().json(), incremental)
+
+
+class OffsetSummaryTests(TestCase):
+    """The offset summaries should follow every write to the losses and gains they are computed from."""
+
+    def setUp(self):
+        permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        self.development = models.Development.objects.create(use=models.Development.MINING, code='D1')
+        permit = models.Permit.objects.create(permit_name=permit_name, development=self.development,
+                                              offset_requirement_stipulated=models.Permit.OFFSET_REQUIREMENT_STIPULATED)
+        self.offset = models.Offset.objects.create(permit=permit, type=models.Offset.HECTARES,
+                                                   duration=models.Offset.PERPETUITY, offset_met=models.Offset.MET)
+
+    def summary(self):
+        return models.DevelopmentOffsetSummary.objects.get(development=self.development)
+
+    def add(self, model, size, name='Renosterveld', **kwargs):
+        return model.objects.create(type=models.Biodiversity.ECOSYSTEM, name=name, size=size, **kwargs)
+
+    def test_balance_follows_writes(self):
+        self.assertEqual((self.summary().total_loss, self.summary().ratio), (0, None))
+
+        self.add(models.BiodiversityLoss, 20, development=self.development)
+        self.add(models.BiodiversityLoss, 20, name='Sand Fynbos', development=self.development)
+        gain = self.add(models.BiodiversityGain, 10, offset=self.offset)
+        summary = self.summary()
+        self.assertEqual((summary.total_loss, summary.total_gain, summary.ratio), (40, 10, 0.25))
+        self.assertEqual(summary.ecosystem_counts, {'Renosterveld': {'loss': 1, 'gain': 1},
+                                                    'Sand Fynbos': {'loss': 1, 'gain': 0}})
+
+        gain.size = 40
+        gain.save()
+        self.assertEqual(self.summary().ratio, 1.0)
+        gain.delete()
+        self.assertEqual((self.summary().total_gain, self.summary().ratio), (0, 0.0))
+
+    def test_rebuild_matches_incremental_summaries(self):
+        self.add(models.BiodiversityLoss, 20, development=self.development)
+        self.add(models.BiodiversityGain, 30, offset=self.offset)
+        incremental = self.summary()
+        summaries.rebuild()
+        rebuilt = self.summary()
+        self.assertEqual((rebuilt.total_loss, rebuilt.total_gain, rebuilt.ratio, rebuilt.ecosystem_counts),
+                         (incremental.total_loss, incremental.total_gain, incremental.ratio,
+                          incremental.ecosystem_counts))
+
+    def test_deleting_the_development_removes_the_summary(self):
+        self.add(models.BiodiversityLoss, 20, development=self.development)
+        self.add(models.BiodiversityGain, 30, offset=self.offset)
+        self.development.delete()
+        self.assertFalse(models.DevelopmentOffsetSummary.objects.exists())
+
+    def test_failed_delete_leaves_refreshes_running(self):
+        with self.assertRaises(ValueError), signals.deleting([self.development.pk]):
+            raise ValueError
+        self.add(models.BiodiversityLoss, 20, development=self.development)
+        self.assertEqual(self.summary().total_loss, 20)
+
+    def test_filtering_on_use_follows_the_developments(self):
+        def filtered():
+            response = self.client.get('/offset-summaries', {'development__use': models.Development.RESIDENTIAL},
+                                       HTTP_ACCEPT='application/json')
+            return len(response.json()['results'])
+
+        self.assertEqual(filtered(), 0)
+        self.development.use = models.Development.RESIDENTIAL
+        self.development.save()
+        self.assertEqual(filtered(), 1)
+
+
+class ListQueryCountTests(TestCase):
+    """Listing a page of any endpoint should take the same number of queries however many rows there are."""
+
+    # The table versions for the ETag, then the page
+    QUERIES = {
+        'developments': 2,
+        'developments-geo': 2,
+        'permit-names': 2,
+        'permits': 2,
+        'biodiversity-loss': 2,
+        'biodiversity-gain': 2,
+        'implementation-times': 2,
+        # The page of offsets, then their implementation times
+        'offsets': 3,
+        'offsets-geo': 3,
+        # The versions, the count for the page numbers, then the page
+        'offset-summaries': 3,
+    }
+
+    def setUp(self):
+        caches[settings.API_CACHE].clear()
+
+    def grow_to(self, count):
+        """Adds rows to every table until they each have count rows"""
+        start = models.Development.objects.count()
+        new = range(start, count)
+        models.PermitName.objects.bulk_create([models.PermitName(name=str(i), authority='DEA') for i in new])
+        models.OffsetImplementationTime.objects.bulk_create([models.OffsetImplementationTime(name=str(i)) for i in new])
+        developments = models.Development.objects.bulk_create([
+            models.Development(use=models.Development.MINING, code=str(i)) for i in new])
+        permit_names = models.PermitName.objects.order_by('-id')[:len(new)]
+        permits = models.Permit.objects.bulk_create([
+            models.Permit(permit_name=permit_name, development=development,
+                          offset_requirement_stipulated=models.Permit.OFFSET_REQUIREMENT_STIPULATED)
+            for permit_name, development in zip(permit_names, developments)])
+        offsets = models.Offset.objects.bulk_create([
+            models.Offset(permit=permit, type=models.Offset.HECTARES, duration=models.Offset.PERPETUITY,
+                          offset_met=models.Offset.MET) for permit in permits])
+        i_times = list(models.OffsetImplementationTime.objects.all()[:2])
+        Through = models.Offset.implementation_times.through
+        Through.objects.bulk_create([Through(offset_id=offset.pk, offsetimplementationtime_id=i_time.pk)
+                                     for offset in offsets for i_time in i_times])
+        for development, offset in zip(developments, offsets):
+            models.BiodiversityLoss.objects.create(type=models.Biodiversity.ECOSYSTEM, name='Renosterveld', size=10,
+                                                   development=development)
+            models.BiodiversityGain.objects.create(type=models.Biodiversity.ECOSYSTEM, name='Renosterveld', size=10,
+                                                   offset=offset)
+        # The bulk inserts go around the signals, as they do in load_input
+        models.TableVersion.bump(*signals.VERSIONED_MODELS)
+
+    def test_list_query_counts_are_constant(self):
+        for count in (10, 100, 1000):
+            self.grow_to(count)
+            for endpoint, queries in self.QUERIES.items():
+                with self.subTest(endpoint=endpoint, rows=count), self.assertNumQueries(queries):
+                    response = self.client.get('/' + endpoint, HTTP_ACCEPT='application/json')
+                    self.assertEqual(response.status_code, 200)
+
+
+class ConditionalRequestTests(TestCase):
+    """Unchanged tables should be answered from the table versions, without querying or serializing the rows."""
+
+    def setUp(self):
+        caches[settings.API_CACHE].clear()
+        self.permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+
+    def get(self, path, **headers):
+        return self.client.get(path, HTTP_ACCEPT='application/json', **headers)
+
+    def test_not_modified(self):
+        response = self.get('/permit-names')
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            response = self.get('/permit-names', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Permit names don't keep an updated_at, so there is no row to look up either
+        response = self.get('/permit-names/{}'.format(self.permit_name.pk))
+        with self.assertNumQueries(1):
+            response = self.get('/permit-names/{}'.format(self.permit_name.pk), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_writes_invalidate(self):
+        first = self.get('/permit-names')
+        # Served from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get('/permit-names').json(), first.json())
+
+        self.permit_name.name = 'Water Use License'
+        self.permit_name.save()
+        response = self.get('/permit-names', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(response.json()['results'][0]['name'], 'Water Use License')
+
+
+class FilterTests(TestCase):
+    def test_every_filter_is_indexed(self):
+        self.assertEqual(checks.check_filter_indexes(None), [])
+
+    def test_offsets_filter_on_their_permits_development(self):
+        permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        offsets = []
+        for code in ('D1', 'D2'):
+            development = models.Development.objects.create(use=models.Development.MINING, code=code)
+            permit = models.Permit.objects.create(
+                permit_name=permit_name, development=development,
+                offset_requirement_stipulated=models.Permit.OFFSET_REQUIREMENT_STIPULATED)
+            offsets.append(models.Offset.objects.create(permit=permit, type=models.Offset.HECTARES,
+                                                        duration=models.Offset.PERPETUITY,
+                                                        offset_met=models.Offset.MET))
+
+        development = offsets[1].permit.development_id
+        self.assertEqual(self.filtered_ids(development), {'/offsets': [offsets[1].pk], '/offsets-geo': [offsets[1].pk]})
+
+        # Moving a permit to another development changes the filtered pages, though no offset was written
+        permit = offsets[0].permit
+        permit.development_id = development
+        permit.save()
+        ids = sorted(offset.pk for offset in offsets)
+        self.assertEqual(self.filtered_ids(development), {'/offsets': ids, '/offsets-geo': ids})
+
+    def filtered_ids(self, development):
+        ids = {}
+        for path in ('/offsets', '/offsets-geo'):
+            data = self.client.get(path, {'development': development}, HTTP_ACCEPT='application/json').json()
+            ids[path] = sorted(offset['id'] for offset in data.get('results', data.get('features')))
+        return ids
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        development = models.Development.objects.create(use=models.Development.RESIDENTIAL, code='GP-101',
+                                                        location_description='North of Johannesburg')
+        self.permit = models.Permit.objects.create(
+            permit_name=permit_name, development=development, reference_no='12/12/20/1234',
+            case_officer='Thandiwe Mokoena', application_title='Establishment of the Northern Golf Course Estate',
+            offset_requirement_stipulated=models.Permit.OFFSET_REQUIREMENT_STIPULATED)
+
+    def search(self, text):
+        return self.client.get('/search', {'q': text}, HTTP_ACCEPT='application/json').json()
+
+    def test_words_are_ranked_and_highlighted(self):
+        permits = self.search('golf estates')['permits']
+        self.assertEqual([permit['id'] for permit in permits], [self.permit.pk])
+        self.assertIn('<mark>Golf</mark>', permits[0]['headline'])
+
+    def test_names_match_fuzzily(self):
+        self.assertEqual([permit['id'] for permit in self.search('Thandiwe Mokena')['permits']], [self.permit.pk])
+
+    def test_vector_follows_saves(self):
+        self.permit.activity_description = 'Residential units and internal roads'
+        self.permit.save()
+        self.assertEqual([permit['id'] for permit in self.search('roads')['permits']], [self.permit.pk])
+        self.assertEqual(self.search('johannesburg')['developments'][0]['code'], 'GP-101')
+
+
+class MetadataTests(TestCase):
+    def cached_permit_metadata(self):
+        return [key for key in serializers.GeoMetadata.serializer_info if key[0] is serializers.PermitSerializer]
+
+    def test_options_served_from_memory(self):
+        first = self.client.options('/permits', HTTP_ACCEPT='application/json').json()
+        self.assertEqual(len(self.cached_permit_metadata()), 1)
+        self.assertEqual(self.client.options('/permits', HTTP_ACCEPT='application/json').json(), first)
+        self.assertEqual(len(self.cached_permit_metadata()), 1)
+
+
+class BulkTests(TestCase):
+    """The bulk endpoints should write every row or none, and keep the derived tables in step as the signals do."""
+
+    def setUp(self):
+        self.permit_name = models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        self.developments = [models.Development.objects.create(use=models.Development.MINING, code=str(i))
+                             for i in range(3)]
+
+    def send(self, method, rows):
+        return getattr(self.client, method)('/permits/bulk', json.dumps(rows), content_type='application/json',
+                                            HTTP_ACCEPT='application/json')
+
+    def permit_rows(self, count):
+        return [{'permit_name': 'http://testserver/permit-names/{}'.format(self.permit_name.pk),
+                 'development': 'http://testserver/developments/{}'.format(development.pk),
+                 'date_issued': '2016-01-0{}'.format(i + 1), 'reference_no': 'REF-{}'.format(i)}
+                for i, development in enumerate(self.developments[:count])]
+
+    def permits_per_year(self):
+        return list(models.StatisticCount.objects.filter(chart=models.StatisticCount.PERMITS_PER_YEAR)
+                    .values_list('key', 'value'))
+
+    def test_create_update_and_delete(self):
+        response = self.send('post', self.permit_rows(3))
+        self.assertEqual(response.status_code, 201)
+        ids = [row['id'] for row in response.json()]
+        self.assertEqual(models.Permit.objects.filter(pk__in=ids).count(), 3)
+        self.assertEqual(self.permits_per_year(), [('2016', 3)])
+
+        response = self.send('patch', [{'id': ids[0], 'date_issued': '2017-03-01'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(models.Permit.objects.get(pk=ids[0]).date_issued, date(2017, 3, 1))
+        self.assertEqual(sorted(self.permits_per_year()), [('2016', 2), ('2017', 1)])
+
+        self.assertEqual(self.send('delete', ids[1:]).status_code, 204)
+        self.assertEqual(list(models.Permit.objects.values_list('pk', flat=True)), ids[:1])
+        self.assertEqual(self.permits_per_year(), [('2017', 1)])
+
+    def test_query_count_is_constant(self):
+        # One query per relation, one insert, then a fixed number to refresh what the signals would have
+        counts = []
+        for count in (1, 3):
+            models.Permit.objects.all().delete()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.send('post', self.permit_rows(count)).status_code, 201)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_errors_are_reported_per_row(self):
+        rows = self.permit_rows(3)
+        rows[1]['development'] = 'http://testserver/developments/0'
+        response = self.send('post', rows)
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual((errors[0], errors[2]), ({}, {}))
+        self.assertIn('development', errors[1])
+        self.assertFalse(models.Permit.objects.exists())
+
+        response = self.send('put', [{'id': 0}])
+        self.assertEqual(response.json(), [{'id': ['No row with this id.']}])
+
+    def test_repeated_ids_are_rejected(self):
+        ids = [row['id'] for row in self.send('post', self.permit_rows(2)).json()]
+        response = self.send('patch', [{'id': ids[0], 'reference_no': 'A'}, {'id': ids[1], 'reference_no': 'B'},
+                                       {'id': ids[0], 'reference_no': 'C'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), [{'id': ['This id appears more than once.']}, {},
+                                           {'id': ['This id appears more than once.']}])
+        self.assertEqual(models.Permit.objects.get(pk=ids[0]).reference_no, 'REF-0')
+
+
+class SuspendedSignalsTests(SimpleTestCase):
+    def test_nested_suspension_lasts_until_the_outermost_ends(self):
+        with signals.suspended():
+            with signals.suspended():
+                self.assertTrue(signals.is_suspended())
+            self.assertTrue(signals.is_suspended())
+        self.assertFalse(signals.is_suspended())
+
+
+class LoadInputMixin(object):
+    """Writes input files for the load_input command to a temporary directory"""
+
+    def setUp(self):
+        super(LoadInputMixin, self).setUp()
+        models.PermitName.objects.create(name='Environmental Impact Assessment', authority='DEA')
+        models.OffsetImplementationTime.objects.create(name='Before development')
+        self.input_dir = tempfile.mkdtemp()
+
+    def write_input(self, rows, location='Farm '):
+        """rows are (unique_id, type, x) tuples, for a development with a square footprint at x and an offset above it"""
+        def squares(y):
+            return {'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'Uniq_ID': uid},
+                 'geometry': {'type': 'Polygon', 'coordinates': [[[x, y], [x, y + 1], [x + 1, y + 1], [x + 1, y],
+                                                                  [x, y]]]}}
+                for uid, _, x in rows]}
+
+        for name, y in (('development_sites.geojson', 0), ('offsets_receiving_areas.geojson', 2)):
+            with open(os.path.join(self.input_dir, name), 'w') as file_obj:
+                json.dump(squares(y), file_obj)
+        self.write_csv('dev_info_spreadsheet.csv', [
+            {'unique_id': uid, 'date_issued': '2016/01/01', 'reference_no': 'REF-' + uid,
+             'location_description': location + uid, 'case_officer': '',
+             'application_title': '', 'activity_description': '', 'environmental_consultancy': '',
+             'environmental_assessment_practitioner': ''} for uid, _, _ in rows])
+        self.write_csv('offsets_spreadsheet.csv', [
+            {'unique_id': uid, 'year': '2016', 'type': use, 'permit_eia': 'x', 'duration': 'Perpetuity',
+             'implement_before': 'x'} for uid, use, _ in rows])
+
+    def write_csv(self, name, rows):
+        with open(os.path.join(self.input_dir, name), 'w') as file_obj:
+            writer = csv.DictWriter(file_obj, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def load(self, **options):
+        options.setdefault('local_vegetation', True)
+        output = io.StringIO()
+        call_command('load_input', input_dir=self.input_dir, stdout=output, **options)
+        return output.getvalue()
+
+    def development_ids(self):
+        return dict(models.Development.objects.values_list('code', 'pk'))
+
+
+class IncrementalLoadTests(LoadInputMixin, TestCase):
+    """An incremental load should only rewrite the rows which changed, keeping the ids of the developments."""
+
+    def test_only_changes_are_written(self):
+        self.write_input([('A', 'Mining', 0), ('B', 'Mining', 2), ('C', 'Mining', 4)])
+        self.assertIn('Developments: 3 new, 0 changed, 0 unchanged, 0 removed', self.load(incremental=True))
+        self.assertEqual(models.Development.objects.get(code='A').location_description, 'Farm A')
+        ids = self.development_ids()
+        offsets = dict(models.Offset.objects.values_list('permit__development__code', 'pk'))
+        gain = models.BiodiversityGain.objects.create(type=models.Biodiversity.ECOSYSTEM, offset_id=offsets['B'])
+        models.BiodiversityGain.objects.create(type=models.Biodiversity.ECOSYSTEM, offset_id=offsets['C'])
+
+        self.write_input([('A', 'Mining', 0), ('B', 'Industrial', 2), ('D', 'Mining', 6)])
+        self.assertIn('Developments: 1 new, 1 changed, 1 unchanged, 1 removed', self.load(incremental=True))
+        self.assertEqual(sorted(self.development_ids()), ['A', 'B', 'D'])
+        self.assertEqual((self.development_ids()['A'], self.development_ids()['B']), (ids['A'], ids['B']))
+        self.assertEqual(models.Development.objects.get(code='B').use, models.Development.INDUSTRIAL)
+        # The removed development's permits, offset and gains went with it
+        self.assertEqual(sorted(models.Permit.objects.values_list('development__code', flat=True)), ['A', 'B', 'D'])
+        self.assertEqual(models.Offset.objects.get(permit__development__code='A').pk, offsets['A'])
+        # The changed development's offset is built again, with its gains moved onto it
+        offset = models.Offset.objects.get(permit__development__code='B')
+        self.assertNotEqual(offset.pk, offsets['B'])
+        self.assertEqual(list(offset.biodiversity_gains.values_list('pk', flat=True)), [gain.pk])
+        self.assertEqual(models.BiodiversityGain.objects.count(), 1)
+        self.assertEqual(offset.implementation_times.count(), 1)
+
+        ids = self.development_ids()
+        self.assertIn('Developments: 0 new, 0 changed, 3 unchanged, 0 removed', self.load(incremental=True))
+        self.assertEqual(self.development_ids(), ids)
+
+        # Columns of the dev info spreadsheet count as changes too
+        self.write_input([('A', 'Mining', 0), ('B', 'Industrial', 2), ('D', 'Mining', 6)], location='Plot ')
+        self.assertIn('Developments: 0 new, 3 changed, 0 unchanged, 0 removed', self.load(incremental=True))
+        self.assertEqual(self.development_ids(), ids)
+        self.assertEqual(models.Development.objects.get(code='A').location_description, 'Plot A')
+
+
+class CopyLoaderTests(TestCase):
+    """Reference layers should be swapped in whole, with their indexes, and bad features logged rather than loaded."""
+
+    def setUp(self):
+        self.square = MultiPolygon(Polygon(((0, 0), (0, 1), (1, 1), (1, 0), (0, 0))), srid=4326)
+        models.VegetationType.objects.create(name='Old', polygon=self.square)
+        self.log = os.path.join(tempfile.mkdtemp(), 'rejected.jsonl')
+
+    def build(self, feature):
+        return {'polygon': feature.geometry, 'name': feature.properties['NAME'],
+                'biome': feature.properties.get('BIOME')}
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s ORDER BY indexname',
+                           [models.VegetationType._meta.db_table])
+            return cursor.fetchall()
+
+    def test_replaces_the_table(self):
+        indexes = self.indexes()
+        batches = [[helpers.Feature({'NAME': 'Sand Fynbos', 'BIOME': 'Fynbos'}, self.square),
+                    helpers.Feature({'BIOME': 'Fynbos'}, self.square)],
+                   [helpers.Feature({'NAME': 'Renosterveld\tWest'}, self.square),
+                    helpers.Feature({'NAME': 'No polygon'}, None)]]
+        counts = loaders.copy_replace(models.VegetationType, batches, self.build, self.log)
+
+        self.assertEqual(counts, {'loaded': 2, 'kept': 0, 'rejected': 2})
+        self.assertEqual(sorted(models.VegetationType.objects.values_list('name', 'biome')),
+                         [('Renosterveld\tWest', None), ('Sand Fynbos', 'Fynbos')])
+        self.assertTrue(models.VegetationType.objects.filter(polygon__intersects=self.square).exists())
+        self.assertEqual(self.indexes(), indexes)
+        with open(self.log) as log:
+            self.assertEqual([json.loads(line)['feature'] for line in log], [2, 4])
+        # The id sequence moved to the new table with it
+        models.VegetationType.objects.create(name='New', polygon=self.square)
+
+    def test_rows_the_table_cant_hold_are_rejected(self):
+        line = GEOSGeometry('LINESTRING (0 0, 1 1)', srid=4326)
+        batches = [[helpers.Feature({'NAME': 'x' * 201}, self.square),
+                    helpers.Feature({'NAME': 'Polygon'}, self.square[0]),
+                    helpers.Feature({'NAME': 'Line'}, line)],
+                   # Gets past the checks, but not the database, which leaves the rest of its batch loaded
+                   [helpers.Feature({'NAME': 'Nul\x00'}, self.square),
+                    helpers.Feature({'NAME': 'Sand Fynbos'}, self.square)]]
+        counts = loaders.copy_replace(models.VegetationType, batches, self.build, self.log)
+
+        self.assertEqual(counts, {'loaded': 2, 'kept': 0, 'rejected': 3})
+        self.assertEqual(sorted(models.VegetationType.objects.values_list('name', flat=True)),
+                         ['Polygon', 'Sand Fynbos'])
+        self.assertEqual(models.VegetationType.objects.get(name='Polygon').polygon.geom_type, 'MultiPolygon')
+        with open(self.log) as log:
+            self.assertEqual([json.loads(line)['feature'] for line in log], [1, 3, 4])
+
+    def test_foreign_keys(self):
+        table = models.VegetationType._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} ADD COLUMN development_id integer '
+                           'CONSTRAINT vegetation_development_fk REFERENCES core_development (id)'.format(table))
+        batches = [[helpers.Feature({'NAME': 'Sand Fynbos'}, self.square)]]
+        loaders.copy_replace(models.VegetationType, batches, self.build, self.log)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+                           [table])
+            self.assertEqual(cursor.fetchall(), [('vegetation_development_fk',)])
+
+            # Rows of other tables would be left pointing at ids which are gone
+            cursor.execute('CREATE TABLE vegetation_note (vegetation_id integer REFERENCES {} (id))'.format(table))
+        with self.assertRaises(ValueError):
+            loaders.copy_replace(models.VegetationType, batches, self.build, self.log)
+
+
+class GeometryRepairTests(TestCase):
+    def test_faults_are_repaired_and_reported(self):
+        bowtie = Polygon(((0, 0), (1, 1), (1, 0), (0, 1), (0, 0)), srid=4326)
+        repeated = Polygon(((0, 0), (0, 1), (0, 1), (1, 1), (1, 0), (0, 0)))
+        two_parts = MultiPolygon(Polygon(((0, 0), (0, 1), (1, 1), (0, 0))),
+                                 Polygon(((2, 2), (2, 3), (3, 3), (2, 2))), srid=4326)
+        results = geometry.repair_many([bowtie, repeated, two_parts])
+
+        self.assertEqual([faults for _, faults in results],
+                         [['Self-intersection'], ['missing SRID', 'repeated vertices'], []])
+        for repaired, _ in results:
+            self.assertEqual((repaired.geom_type, repaired.srid, repaired.valid), ('MultiPolygon', 4326, True))
+        self.assertEqual(results[0][0].num_geom, 2)
+        self.assertEqual(results[1][0].num_points, 5)
+        # Every part of a MultiPolygon is kept
+        self.assertEqual(results[2][0].num_geom, 2)
+
+
+class ComputeAreaInfoTests(TestCase):
+    def test_invalid_footprints_are_repaired(self):
+        square = MultiPolygon(Polygon(((0, 0), (0, 1), (1, 1), (1, 0), (0, 0))), srid=4326)
+        bowtie = MultiPolygon(Polygon(((0, 0), (1, 1), (1, 0), (0, 1), (0, 0))), srid=4326)
+        models.VegetationType.objects.create(name='Sand Fynbos', biome='Fynbos', polygon=square)
+        development = models.Development.objects.create(use=models.Development.MINING, code='1', footprint=bowtie)
+
+        self.assertEqual(services.compute_area_info()['development'], 1)
+        info = models.Development.objects.get(pk=development.pk).geo_info
+        self.assertEqual(list(info), ['Sand Fynbos'])
+        self.assertEqual((info['Sand Fynbos']['status'], info['Sand Fynbos']['type']), ('calculated', 'Fynbos'))
+        self.assertGreater(info['Sand Fynbos']['area'], 0)
+
+
+class ArrowExportTests(TestCase):
+    def setUp(self):
+        self.footprint = MultiPolygon(Polygon(((18, -34), (18, -33), (19, -33), (19, -34), (18, -34))), srid=4326)
+        self.developments = [models.Development.objects.create(use=models.Development.MINING, code=str(i),
+                                                               footprint=self.footprint)
+                             for i in range(3)]
+
+    def read(self, params):
+        response = self.client.get('/developments-geo', dict(params, format='arrow'))
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        return pa.open_stream(io.BytesIO(b''.join(response.streaming_content))).read_all()
+
+    def test_round_trip(self):
+        table = self.read({})
+        schema = table.schema
+        self.assertEqual(schema.field_by_name('id').type, pa.int32())
+        self.assertEqual(schema.field_by_name('use').type, pa.string())
+        self.assertEqual(schema.field_by_name('geometry').type, pa.binary())
+        self.assertEqual(json.loads(schema.metadata[b'geo'].decode())['primary_column'], 'geometry')
+
+        frame = table.to_pandas()
+        self.assertEqual(frame['id'].tolist(), [development.pk for development in self.developments])
+        self.assertEqual(frame['use'].tolist(), [models.Development.MINING] * 3)
+        geometry = GEOSGeometry(memoryview(frame['geometry'][0]))
+        self.assertTrue(geometry.equals(self.footprint))
+
+    def test_fields_and_geometry_can_be_left_out(self):
+        table = self.read({'fields': 'id,code', 'geometry': 'false'})
+        self.assertEqual(table.schema.names, ['id', 'code'])
+
+    def test_errors_are_json(self):
+        response = self.client.get('/developments-geo', {'format': 'arrow', 'zoom': 'far'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('zoom', response.json()['detail'])
+
+
+class TileTests(TestCase):
+    """Tiles should be cached until their table changes, and revalidated with their ETag."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        override = override_settings(TILE_CACHE_DIR=self.cache_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        square = MultiPolygon(Polygon(((18, -34), (18, -33), (19, -33), (19, -34), (18, -34))), srid=4326)
+        self.development = models.Development.objects.create(use=models.Development.MINING, code='D1',
+                                                             footprint=square)
+
+    def get(self, path='/tiles/developments/0/0/0.pbf', **headers):
+        return self.client.get(path, **headers)
+
+    def versions(self):
+        return sorted(os.listdir(os.path.join(self.cache_dir, 'developments')))
+
+    def test_tiles_are_cached_and_revalidated(self):
+        response = self.get()
+        self.assertEqual((response.status_code, response['Content-Type']),
+                         (200, 'application/vnd.mapbox-vector-tile'))
+        self.assertTrue(response.content)
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Served from the disk cache, only the table version is read, for the ETag and then the cache path
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get().content, response.content)
+
+        self.development.use = models.Development.RESIDENTIAL
+        self.development.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(self.versions()), 1)
+
+    def test_tiles_outside_the_world_are_not_found(self):
+        self.assertEqual(self.get('/tiles/developments/1/2/0.pbf').status_code, 404)
+        self.assertEqual(self.get('/tiles/rivers/0/0/0.pbf').status_code, 404)
+
+    def test_older_versions_leave_newer_ones_alone(self):
+        urls = {'development': '/developments/'}
+        tiles.get_tile('developments', 5, 0, 0, 0, urls)
+        tile = tiles.get_tile('developments', 3, 0, 0, 0, urls)
+        self.assertTrue(tile)
+        self.assertEqual(self.versions(), ['3', '5'])
+        tiles.get_tile('developments', 6, 0, 0, 0, urls)
+        self.assertEqual(self.versions(), ['6'])
+
+
+class VegMapHandler(BaseHTTPRequestHandler):
+    """Stand-in for the VegMap identify service, naming the vegetation type after the polygon's first x coordinate"""
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        geometry = parse_qs(self.rfile.read(length).decode())['geometry'][0]
+        self.server.request_count += 1
+
+        if self.server.failures_left:
+            self.server.failures_left -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        x = re.search(r'\[\[\[(-?[\d.]+)', geometry).group(1)
+        if float(x) < 0:
+            body = {'error': {'code': 400, 'message': 'Invalid geometry'}}
+        else:
+            body = {'results': [{'value': 'Vegetation ' + x, 'layerName': 'VegMap 2012'}]}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class VegMapServerMixin(object):
+    """Runs a VegMapHandler for each test, with a client for it in self.vegmap"""
+
+    def setUp(self):
+        super(VegMapServerMixin, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), VegMapHandler)
+        self.server.request_count = 0
+        self.server.failures_left = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.vegmap = services.VegMapClient(url='http://127.0.0.1:{}/identify'.format(self.server.server_port),
+                                            workers=4, retries=2, backoff=0)
+
+    def square(self, x):
+        return Polygon(((x, 0), (x, 1), (x + 1, 1), (x + 1, 0), (x, 0)))
+
+
+class VegMapClientTests(VegMapServerMixin, SimpleTestCase):
+    def test_batch_results_are_in_order(self):
+        results = self.vegmap.identify_many([self.square(x) for x in range(10)])
+        self.assertEqual([list(info) for info in results], [['Vegetation {}.0'.format(x)] for x in range(10)])
+
+    def test_retries_server_errors(self):
+        self.server.failures_left = 2
+        self.assertEqual(list(self.vegmap.identify(self.square(1))), ['Vegetation 1.0'])
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_failures_are_structured(self):
+        results = self.vegmap.identify_many([self.square(1), self.square(-5)])
+        self.assertEqual(list(results[0]), ['Vegetation 1.0'])
+        self.assertIsInstance(results[1], services.AreaInfoError)
+        self.assertEqual(results[1].status_code, 200)
+
+        self.server.failures_left = 3
+        with self.assertRaises(services.AreaInfoError):
+            self.vegmap.identify(self.square(1))
+
+
+class AreaInfoCacheTests(VegMapServerMixin, TestCase):
+    """Polygons we have seen before should be answered from AreaInfo, until they expire or are evicted."""
+
+    def setUp(self):
+        super(AreaInfoCacheTests, self).setUp()
+        self.addCleanup(setattr, services, '_client', services._client)
+        services._client = self.vegmap
+        services.cache_stats.clear()
+
+    def age(self, key, **delta):
+        models.AreaInfo.objects.filter(key=key).update(created=timezone.now() - timedelta(**delta))
+
+    def test_hits_and_misses(self):
+        results = services.get_area_info_many([self.square(1), self.square(2), self.square(1), self.square(-5)])
+        self.assertEqual([list(info) for info in results[:3]],
+                         [['Vegetation 1.0'], ['Vegetation 2.0'], ['Vegetation 1.0']])
+        self.assertIsInstance(results[3], services.AreaInfoError)
+        self.assertEqual(self.server.request_count, 3)
+        # Failed lookups aren't cached
+        self.assertEqual(models.AreaInfo.objects.count(), 2)
+
+        # The same shape starting from another vertex is the same entry
+        rotated = Polygon(((2, 1), (2, 0), (1, 0), (1, 1), (2, 1)))
+        self.assertEqual(list(services.get_area_info(rotated)), ['Vegetation 1.0'])
+        self.assertEqual(self.server.request_count, 3)
+        self.assertEqual((services.cache_stats['hits'], services.cache_stats['misses'],
+                          services.cache_stats['failures']), (1, 3, 1))
+
+    @override_settings(AREA_INFO_CACHE_TTL=60)
+    def test_expired_entries_are_looked_up_again(self):
+        services.get_area_info(self.square(1))
+        key = services.geometry_key(self.square(1))
+        self.assertEqual(list(services.get_cached_area_info([key])), [key])
+
+        self.age(key, minutes=2)
+        self.assertEqual(services.get_cached_area_info([key]), {})
+        services.get_area_info(self.square(1))
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(list(services.get_cached_area_info([key])), [key])
+
+    @override_settings(AREA_INFO_CACHE_TTL=60, AREA_INFO_CACHE_MAX_ENTRIES=2)
+    def test_purge_removes_expired_then_least_recently_used(self):
+        for key in 'abcd':
+            services.cache_area_info(key, {})
+        self.age('a', minutes=2)
+        for key, hours in (('b', 1), ('c', 2), ('d', 3)):
+            models.AreaInfo.objects.filter(key=key).update(last_used=timezone.now() - timedelta(hours=hours))
+        # Reading an entry makes it the most recently used
+        services.get_cached_area_info(['d'])
+
+        self.assertEqual(services.purge_area_info_cache(), 2)
+        self.assertEqual(sorted(models.AreaInfo.objects.values_list('key', flat=True)), ['b', 'd'])
+
+    def test_command_prewarms_from_an_export(self):
+        services.get_area_info_many([self.square(1), self.square(2)])
+        path = os.path.join(tempfile.mkdtemp(), 'area_info.json')
+        call_command('area_info_cache', export_path=path, stdout=io.StringIO())
+        with open(path) as file_obj:
+            entries = json.load(file_obj)
+        entries.append({'geometry': json.loads(self.square(3).json), 'info': {'Vegetation 3.0': {}}})
+        with open(path, 'w') as file_obj:
+            json.dump(entries, file_obj)
+
+        models.AreaInfo.objects.all().delete()
+        output = io.StringIO()
+        call_command('area_info_cache', import_path=path, stdout=output)
+        self.assertIn('Imported 3 entries', output.getvalue())
+
+        results = services.get_area_info_many([self.square(x) for x in (1, 2, 3)])
+        self.assertEqual([list(info) for info in results],
+                         [['Vegetation 1.0'], ['Vegetation 2.0'], ['Vegetation 3.0']])
+        self.assertEqual(self.server.request_count, 2)
+
+
+class ParallelLoadTests(VegMapServerMixin, LoadInputMixin, TransactionTestCase):
+    """
+    Sharding a load across worker processes should give the same result as one process, with every write, including
+    those to the vegetation lookup cache, made in the command's transaction. The workers use their own connections, so
+    this can't run inside a TestCase's transaction.
+    """
+
+    def setUp(self):
+        super(ParallelLoadTests, self).setUp()
+        # Forked workers inherit the client
+        self.addCleanup(setattr, services, '_client', services._client)
+        services._client = self.vegmap
+        self.write_input([(uid, 'Mining', 2 * x) for x, uid in enumerate('ABCDEFGH')])
+
+    def load_from_scratch(self, **options):
+        """Loads into empty tables with their sequences reset, so the ids given out can be compared"""
+        models.Development.objects.all().delete()
+        models.AreaInfo.objects.all().delete()
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [models.Development, models.Permit,
+                                                                      models.Offset]):
+                cursor.execute(sql)
+        self.load(local_vegetation=False, **options)
+        return (list(models.Development.objects.order_by('pk').values_list('pk', 'code', 'geo_info', 'source_hash')),
+                list(models.Permit.objects.order_by('pk').values_list('pk', 'development__code')),
+                list(models.Offset.objects.order_by('pk').values_list('pk', 'permit__development__code', 'info')),
+                sorted(models.AreaInfo.objects.values_list('key', 'info')))
+
+    def test_workers_give_the_same_result(self):
+        single = self.load_from_scratch(workers=1)
+        self.assertEqual([code for _, code, _, _ in single[0]], list('ABCDEFGH'))
+        self.assertEqual(len(single[3]), 16)
+        self.assertEqual(self.load_from_scratch(workers=3), single)
+
+    def test_workers_reuse_lookups_from_earlier_batches(self):
+        # The same footprint and offset under two unique_ids, loaded in separate batches
+        self.write_input([('A', 'Mining', 0), ('B', 'Mining', 0)])
+        self.load_from_scratch(workers=2, batch_size=1)
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_dry_run_leaves_the_cache_alone(self):
+        self.load_from_scratch(workers=3, dry_run=True)
+        self.assertEqual(self.server.request_count, 16)
+        self.assertFalse(models.Development.objects.exists())
+        self.assertFalse(models.AreaInfo.objects.exists())
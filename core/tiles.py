@@ -0,0 +1,136 @@
+"""
+Mapbox vector tiles of the development footprints and offset polygons, built in PostGIS with ST_AsMVT. Tiles are cached
+on disk under the version of the table they were built from, so a write to the table invalidates them.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from django.conf import settings
+from django.db import connection
+from core import models
+
+# Half the width of the web mercator (EPSG:3857) world in metres
+WORLD_EXTENT = 20037508.342789244
+
+TILE_SQL = """
+SELECT ST_AsMVT(tile, %s, 4096, 'geom') FROM (
+    SELECT {attributes},
+        ST_AsMVTGeom(ST_Transform(feature.{geometry}, 3857), ST_MakeEnvelope(%s, %s, %s, %s, 3857), 4096, 64, true)
+            AS geom
+    FROM {table} AS feature
+    WHERE {where}feature.{geometry} && ST_Transform(ST_MakeEnvelope(%s, %s, %s, %s, 3857), 4326)
+) AS tile WHERE geom IS NOT NULL
+"""
+
+
+def choice_display(column, choices):
+    """SQL equivalent of get_FOO_display for a choices column, returns (sql, params)"""
+    sql = 'CASE feature.{} {} END'.format(column, ' '.join(['WHEN %s THEN %s'] * len(choices)))
+    return sql, [value for choice in choices for value in choice]
+
+
+def development_attributes(urls):
+    """The same attributes as DevelopmentGeoSerializer, returns (sql, params)"""
+    use_display, use_params = choice_display('use', models.Development.TYPE_CHOICES)
+    sql = "feature.id, %s || feature.id AS url, feature.use, {} AS get_use_display, feature.location_description, " \
+          "feature.code".format(use_display)
+    return sql, [urls['development']] + use_params
+
+
+def offset_attributes(urls):
+    """
+    The same attributes as OffsetGeoSerializer, returns (sql, params). Vector tile attributes can't be lists or objects
+    so implementation_times and info are JSON encoded.
+    """
+    type_display, type_params = choice_display('type', models.Offset.TYPE_CHOICES)
+    through = models.Offset.implementation_times.through._meta.db_table
+    sql = "feature.id, %s || feature.id AS url, %s || feature.permit_id AS permit, feature.type, " \
+          "{type_display} AS get_type_display, feature.duration, " \
+          "(SELECT COALESCE(json_agg(%s || t.offsetimplementationtime_id ORDER BY t.offsetimplementationtime_id), " \
+          "'[]') FROM {through} AS t WHERE t.offset_id = feature.id)::text AS implementation_times, " \
+          "feature.info::text AS info".format(type_display=type_display, through=through)
+    return sql, [urls['offset'], urls['permit']] + type_params + [urls['offsetimplementationtime']]
+
+
+LAYERS = {
+    'developments': {
+        'model': models.Development,
+        'geometry': 'footprint',
+        'attributes': development_attributes,
+        'where': ('', []),
+    },
+    'offsets': {
+        'model': models.Offset,
+        'geometry': 'polygon',
+        'attributes': offset_attributes,
+        # The same offsets as OffsetGeoViewSet
+        'where': ('feature.type = %s AND ', [models.Offset.HECTARES]),
+    },
+}
+
+
+def tile_envelope(z, x, y):
+    """The web mercator bounds (xmin, ymin, xmax, ymax) of a z/x/y tile"""
+    size = 2 * WORLD_EXTENT / 2 ** z
+    xmin = -WORLD_EXTENT + x * size
+    ymax = WORLD_EXTENT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def build_tile(layer, z, x, y, urls):
+    """Builds a tile in the database. urls maps model names to the prefix their hyperlinks start with."""
+    config = LAYERS[layer]
+    attributes, attribute_params = config['attributes'](urls)
+    where, where_params = config['where']
+    envelope = list(tile_envelope(z, x, y))
+    sql = TILE_SQL.format(attributes=attributes, geometry=config['geometry'], table=config['model']._meta.db_table,
+                          where=where)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [layer] + attribute_params + envelope + where_params + envelope)
+        return bytes(cursor.fetchone()[0] or b'')
+
+
+def tile_key(layer, version, z, x, y, urls):
+    """Identifies a tile's content, used both as the ETag and in the cache path"""
+    key = '{}:{}:{}:{}:{}:{}'.format(layer, version, z, x, y, sorted(urls.items()))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def get_tile(layer, version, z, x, y, urls):
+    """Returns a tile from the disk cache, building and caching it if this version of it hasn't been built yet"""
+    layer_dir = os.path.join(settings.TILE_CACHE_DIR, layer)
+    version_dir = os.path.join(layer_dir, str(version))
+    path = os.path.join(version_dir, str(z), str(x), '{}-{}.pbf'.format(y, tile_key(layer, version, z, x, y, urls)))
+    try:
+        with open(path, 'rb') as file_obj:
+            return file_obj.read()
+    except FileNotFoundError:
+        # Not built yet, or removed along with its version since
+        pass
+
+    tile = build_tile(layer, z, x, y, urls)
+    if not os.path.isdir(version_dir):
+        # First tile of a new version, tiles from older versions are stale. Newer versions are left alone, this
+        # request may just be behind a write another one has already seen.
+        remove_older_versions(layer_dir, version)
+    temp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as file_obj:
+            file_obj.write(tile)
+        os.replace(temp_path, path)
+    except FileNotFoundError:
+        # A request for a newer version removed this one's directory while the tile was being written, the tile is
+        # still correct for this request but not worth caching
+        pass
+    return tile
+
+
+def remove_older_versions(layer_dir, version):
+    """Deletes the cached tiles of a layer's versions before the given one"""
+    if not os.path.isdir(layer_dir):
+        return
+    for name in os.listdir(layer_dir):
+        if name.isdigit() and int(name) < version:
+            shutil.rmtree(os.path.join(layer_dir, name), ignore_errors=True)
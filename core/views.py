@@ -1,156 +1,607 @@
+from calendar import timegm
+from collections import Counter
+import hashlib
+import json
+import re
 from rest_framework import viewsets
-from rest_framework.views import APIView
+from rest_framework.filters import OrderingFilter
+from rest_framework.relations import HyperlinkedIdentityField
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import list_route
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+from rest_framework_gis.filters import InBBoxFilter, DistanceToPointFilter
+from rest_framework_gis.serializers import GeoFeatureModelSerializer
+from django_filters.rest_framework import DjangoFilterBackend
+from django.contrib.gis.db.models import GeometryField
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import condition, require_GET
 from core import models
-from django.db.models import Count
-from core import serializers
+from core import bulk, filters, geometry, pagination, renderers, search, serializers, statistics, tiles
 
 
-class DevelopmentViewSet(viewsets.ModelViewSet):
+class StreamingListMixin(object):
+    """
+    Lets list endpoints return every row with ?stream=1 instead of a page. The rows are read from a server side cursor
+    and written out one at a time as a JSON array, or a GeoJSON FeatureCollection for the geo endpoints, so full
+    exports use constant memory.
+    """
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('stream') not in ('1', 'true'):
+            return super(StreamingListMixin, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(self.stream(queryset), content_type='application/json')
+
+    stream_chunk_size = 500
+
+    def stream(self, queryset):
+        serializer = self.get_serializer()
+        is_geo = isinstance(serializer, GeoFeatureModelSerializer)
+        yield '{"type": "FeatureCollection", "features": [' if is_geo else '['
+        for i, instance in enumerate(self.stream_rows(queryset)):
+            yield (',' if i else '') + json.dumps(serializer.to_representation(instance), cls=encoders.JSONEncoder)
+        yield ']}' if is_geo else ']'
+
+    def stream_rows(self, queryset):
+        if not getattr(self, 'prefetch_related_fields', ()):
+            for instance in queryset.iterator():
+                yield instance
+            return
+
+        # iterator() ignores prefetch_related, so walk the rows in keyset chunks which each get their relations
+        # prefetched in one query
+        queryset = queryset.order_by('pk')
+        chunk = list(queryset[:self.stream_chunk_size])
+        while chunk:
+            for instance in chunk:
+                yield instance
+            chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:self.stream_chunk_size])
+
+
+class ConditionalMixin(object):
+    """
+    Answers If-None-Match and If-Modified-Since with a 304 from the table versions alone (see models.TableVersion),
+    before anything is queried or serialized. List pages are also kept in the API cache, keyed on the table versions,
+    so the signals which bump the versions on every write invalidate them. version_models lists any tables the
+    response is built from other than the viewset's own.
+    """
+    version_models = ()
+
+    def get_version_models(self):
+        queryset = getattr(self, 'queryset', None)
+        own = (queryset.model,) if queryset is not None else ()
+        return own + tuple(self.version_models)
+
+    def get_validators(self, request):
+        """Returns the ETag and Last-Modified timestamp of the response to a GET, from the table versions"""
+        versions = models.TableVersion.get_versions(*self.get_version_models()).values()
+        state = ';'.join(sorted('{}:{}'.format(version.table, version.version) for version in versions))
+        key = '|'.join((state, request.build_absolute_uri(), request.accepted_media_type or ''))
+        etag = quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+        stored = [version.updated_at for version in versions if version.pk]
+        last_modified = timegm(max(stored).utctimetuple()) if stored else None
+        return etag, last_modified
+
+    def conditional_response(self, request, build_response, last_modified=None, cache_data=False):
+        etag, table_modified = self.get_validators(request)
+        last_modified = last_modified or table_modified
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self.cached_response(etag, build_response) if cache_data else build_response()
+        if response.status_code < 400:
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ('Accept',))
+        return response
+
+    def cached_response(self, etag, build_response):
+        cache = caches[settings.API_CACHE]
+        key = 'api-list:' + etag.strip('"')
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = build_response()
+        # Streamed responses are never held in memory, let alone cached
+        if isinstance(response, Response) and response.status_code == 200:
+            cache.set(key, response.data)
+        return response
+
+    def get_row_modified(self):
+        """When the requested row was last changed, for the models which keep track"""
+        model = self.queryset.model
+        if 'updated_at' not in [field.name for field in model._meta.concrete_fields]:
+            return None
+        lookup = {self.lookup_field: self.kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        try:
+            updated_at = model.objects.filter(**lookup).values_list('updated_at', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+        return timegm(updated_at.utctimetuple()) if updated_at else None
+
+    def list(self, request, *args, **kwargs):
+        parent = super(ConditionalMixin, self).list
+        return self.conditional_response(request, lambda: parent(request, *args, **kwargs), cache_data=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        parent = super(ConditionalMixin, self).retrieve
+        return self.conditional_response(request, lambda: parent(request, *args, **kwargs),
+                                         last_modified=self.get_row_modified())
+
+
+class EagerLoadingMixin(object):
+    """
+    Viewsets declare the relations their serializer reads in select_related_fields and prefetch_related_fields, so that
+    a page costs the same number of queries however many rows are on it. Hyperlinks to foreign keys only need the id,
+    which is already on the row, so only many to many relations need to be listed.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def get_queryset(self):
+        queryset = super(EagerLoadingMixin, self).get_queryset()
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        if self.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*self.prefetch_related_fields)
+        return queryset
+
+
+class SparseQuerysetMixin(object):
+    """
+    Defers the columns the serializer doesn't need once ?fields=, ?omit= or ?geometry=false have narrowed it down
+    (see serializers.SparseFieldsMixin), and skips prefetching relations which aren't returned.
+    """
+    def get_needed_fields(self, model):
+        """The model fields the serializer reads, or None if it reads something we can't account for"""
+        needed = set()
+        model_fields = set(field.name for field in model._meta.get_fields())
+        for field in self.get_serializer().fields.values():
+            if isinstance(field, serializers.OmittedGeometryField):
+                continue
+            if isinstance(field, HyperlinkedIdentityField):
+                needed.add(model._meta.pk.name)
+                continue
+            name = field.source.split('.')[0]
+            display = re.match(r'^get_(\w+)_display$', name)
+            if display:
+                name = display.group(1)
+            if name not in model_fields:
+                return None
+            needed.add(name)
+        return needed
+
+    def get_queryset(self):
+        queryset = super(SparseQuerysetMixin, self).get_queryset()
+        if self.request.method != 'GET':
+            return queryset
+        needed = self.get_needed_fields(queryset.model)
+        if needed is None:
+            return queryset
+
+        deferred = [field.name for field in queryset.model._meta.concrete_fields
+                    if not field.primary_key and field.name not in needed]
+        queryset = queryset.defer(*deferred)
+        prefetch = [lookup for lookup in getattr(self, 'prefetch_related_fields', ())
+                    if lookup.split('__')[0] in needed]
+        if len(prefetch) != len(getattr(self, 'prefetch_related_fields', ())):
+            queryset = queryset.prefetch_related(None).prefetch_related(*prefetch)
+        return queryset
+
+
+class ArrowExportMixin(object):
+    """
+    Lets geo viewsets export every matching feature with ?format=arrow, as an Arrow IPC stream with WKB geometries
+    (see core.renderers). Filters, ?fields=, ?omit=, ?geometry=false and ?zoom= apply as they do to the JSON output.
+    """
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [renderers.ArrowStreamRenderer]
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != renderers.ArrowStreamRenderer.format:
+            return super(ArrowExportMixin, self).list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        model = queryset.model
+        geo_field = self.get_serializer_class().Meta.geo_field
+        needed = self.get_needed_fields(model)
+        fields = [field for field in model._meta.concrete_fields
+                  if not isinstance(field, GeometryField) and (needed is None or field.name in needed)]
+
+        geometry_source = None
+        if serializers.include_geometry(request):
+            geometry_source = 'simplified_geometry' if 'simplified_geometry' in queryset.query.annotations else geo_field
+
+        response = StreamingHttpResponse(renderers.stream_arrow(queryset, fields, geometry_source),
+                                         content_type=renderers.ARROW_MEDIA_TYPE)
+        response['Content-Disposition'] = 'attachment; filename="{}.arrows"'.format(model._meta.verbose_name_plural.replace(' ', '-'))
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Only the export itself is an Arrow stream, errors and anything else are JSON clients can parse
+        renderer = getattr(request, 'accepted_renderer', None)
+        if isinstance(response, Response) and isinstance(renderer, renderers.ArrowStreamRenderer):
+            request.accepted_renderer = JSONRenderer()
+            request.accepted_media_type = JSONRenderer.media_type
+        return super(ArrowExportMixin, self).finalize_response(request, response, *args, **kwargs)
+
+
+class SimplifiedGeometryMixin(object):
+    """
+    Lets geo viewsets return simplified geometries for overview maps, with ?zoom=<web map zoom level> or
+    ?tolerance=<degrees>. Zoom levels with a precomputed column are read from it, anything else is simplified in the
+    query with ST_SimplifyPreserveTopology.
+    """
+    def get_simplification(self):
+        """Returns the tolerance in degrees to simplify with, or None for full resolution geometries"""
+        params = self.request.query_params
+        try:
+            if 'tolerance' in params:
+                tolerance = float(params['tolerance'])
+                return tolerance if tolerance > 0 else None
+            if 'zoom' in params:
+                zoom = int(params['zoom'])
+                return geometry.zoom_tolerance(zoom) if zoom < geometry.FULL_RESOLUTION_ZOOM else None
+        except ValueError:
+            raise ParseError('zoom must be an integer and tolerance a number')
+        return None
+
+    def get_queryset(self):
+        queryset = super(SimplifiedGeometryMixin, self).get_queryset()
+        geo_field = self.get_serializer_class().Meta.geo_field
+        if self.request.method != 'GET':
+            return queryset
+
+        unused = geometry.simplified_fields(geo_field)
+        if not serializers.include_geometry(self.request):
+            return queryset.defer(geo_field, *unused)
+
+        tolerance = self.get_simplification()
+        zoom = None
+        if tolerance is not None and 'tolerance' not in self.request.query_params:
+            zoom = geometry.precomputed_zoom(int(self.request.query_params['zoom']))
+
+        # Only ever read the one geometry column we are going to return
+        if zoom is not None:
+            column = geometry.simplified_field(geo_field, zoom)
+            unused.remove(column)
+            # Rows saved around the signals may not have the precomputed column yet
+            simplified = Coalesce(F(column), geometry.SimplifyPreserveTopology(geo_field, tolerance))
+        elif tolerance is not None:
+            simplified = geometry.SimplifyPreserveTopology(geo_field, tolerance)
+        else:
+            return queryset.defer(*unused)
+        return queryset.defer(geo_field, *unused).annotate(simplified_geometry=simplified)
+
+
+class BulkMixin(object):
+    """
+    Adds /bulk/ to a viewset, which takes a list of rows and writes them all in one transaction, see core.bulk.
+    POST creates the rows, PUT and PATCH update the rows with the given ids and DELETE deletes a list of ids. When any
+    row is invalid nothing is written, and the errors are returned in a list with an entry for each row.
+    """
+    bulk_max_rows = 1000
+
+    def get_bulk_rows(self, request):
+        if not isinstance(request.data, list):
+            raise ParseError('Expected a list of rows')
+        if len(request.data) > self.bulk_max_rows:
+            raise ParseError('At most {} rows can be written at a time'.format(self.bulk_max_rows))
+        return request.data
+
+    def get_bulk_instances(self, ids):
+        """
+        Loads the rows with the given ids in one query, returning them by id and the errors of unknown or repeated ids.
+        A row can only be written once per request, otherwise which of its versions is saved would depend on the order.
+        """
+        valid = []
+        for pk in ids:
+            try:
+                valid.append(int(pk))
+            except (TypeError, ValueError):
+                pass
+        instances = self.get_queryset().in_bulk(valid)
+        repeated = {pk for pk, count in Counter(valid).items() if count > 1}
+        errors = []
+        for pk in ids:
+            try:
+                pk = int(pk)
+            except (TypeError, ValueError):
+                pk = None
+            if pk not in instances:
+                errors.append({'id': ['No row with this id.']})
+            elif pk in repeated:
+                errors.append({'id': ['This id appears more than once.']})
+            else:
+                errors.append({})
+        return instances, errors
+
+    @list_route(methods=['post', 'put', 'patch', 'delete'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        rows = self.get_bulk_rows(request)
+        if request.method == 'DELETE':
+            instances, errors = self.get_bulk_instances(rows)
+            if any(errors):
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            with transaction.atomic():
+                bulk.bulk_delete(self.get_queryset(), list(instances))
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        instances = None
+        if request.method != 'POST':
+            ids = [row.get('id') if isinstance(row, dict) else None for row in rows]
+            found, errors = self.get_bulk_instances(ids)
+            if any(errors):
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            instances = [found[int(pk)] for pk in ids]
+
+        serializer = self.get_serializer(instances, data=rows, many=True, partial=request.method == 'PATCH')
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            saved = serializer.save()
+        prefetch_related_objects(saved, *self.prefetch_related_fields)
+        return Response(self.get_serializer(saved, many=True).data,
+                        status=status.HTTP_201_CREATED if request.method == 'POST' else status.HTTP_200_OK)
+
+
+class DevelopmentViewSet(ConditionalMixin, BulkMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.Development.objects.all()
     serializer_class = serializers.DevelopmentSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    filter_class = filters.DevelopmentFilter
+    ordering_fields = ('id', 'use')
+    ordering = ('id',)
 
 
-class DevelopmentGeoViewSet(viewsets.ModelViewSet):
+class DevelopmentGeoViewSet(ConditionalMixin, ArrowExportMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, SimplifiedGeometryMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.Development.objects.all()
     serializer_class = serializers.DevelopmentGeoSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    pagination_class = pagination.GeoJsonCursorPagination
+
+    # Spatial filters, ?in_bbox=, ?point=&dist= (in metres) and ?intersects=, all backed by the GiST index, as well
+    # as the ones in core.filters
+    filter_backends = (InBBoxFilter, DistanceToPointFilter, DjangoFilterBackend, OrderingFilter)
+    filter_class = filters.DevelopmentGeoFilter
+    ordering_fields = ('id', 'use')
+    ordering = ('id',)
+    bbox_filter_field = 'footprint'
+    bbox_filter_include_overlapping = True
+    distance_filter_field = 'footprint'
+    distance_filter_convert_meters = True
 
 
-class BiodiversityLossViewSet(viewsets.ModelViewSet):
+class BiodiversityLossViewSet(ConditionalMixin, BulkMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.BiodiversityLoss.objects.all()
     serializer_class = serializers.BiodiversityLossSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    filter_class = filters.BiodiversityLossFilter
+    ordering_fields = ('id', 'type')
+    ordering = ('id',)
 
 
-class BiodiversityGainViewSet(viewsets.ModelViewSet):
+class BiodiversityGainViewSet(ConditionalMixin, BulkMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.BiodiversityGain.objects.all()
     serializer_class = serializers.BiodiversityGainSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    filter_class = filters.BiodiversityGainFilter
+    ordering_fields = ('id', 'type')
+    ordering = ('id',)
 
 
-class PermitViewSet(viewsets.ModelViewSet):
+class PermitViewSet(ConditionalMixin, BulkMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.Permit.objects.all()
     serializer_class = serializers.PermitSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    filter_class = filters.PermitFilter
+    ordering_fields = ('id',)
+    ordering = ('id',)
 
 
-class PermitNameViewSet(viewsets.ModelViewSet):
+class PermitNameViewSet(ConditionalMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.PermitName.objects.all()
     serializer_class = serializers.PermitNameSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    ordering_fields = ('id',)
+    ordering = ('id',)
 
 
-class ImplementationTimeViewSet(viewsets.ModelViewSet):
+class ImplementationTimeViewSet(ConditionalMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     queryset = models.OffsetImplementationTime.objects.all()
     serializer_class = serializers.ImplementationTimeSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    ordering_fields = ('id',)
+    ordering = ('id',)
 
 
-class OffsetGeoViewSet(viewsets.ModelViewSet):
+class OffsetGeoViewSet(ConditionalMixin, ArrowExportMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, SimplifiedGeometryMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.Offset.objects.all()
     serializer_class = serializers.OffsetGeoSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ('implementation_times',)
+    # ?development= goes through the offset's permit
+    version_models = (models.Permit,)
+    pagination_class = pagination.GeoJsonCursorPagination
+
+    # Spatial filters, ?in_bbox=, ?point=&dist= (in metres) and ?intersects=, all backed by the GiST index, as well
+    # as the ones in core.filters
+    filter_backends = (InBBoxFilter, DistanceToPointFilter, DjangoFilterBackend, OrderingFilter)
+    filter_class = filters.OffsetGeoFilter
+    ordering_fields = ('id', 'offset_met', 'duration')
+    ordering = ('id',)
+    bbox_filter_field = 'polygon'
+    bbox_filter_include_overlapping = True
+    distance_filter_field = 'polygon'
+    distance_filter_convert_meters = True
 
     def get_queryset(self):
         """
-        Optionally restricts the returned offsets to a given development
+        Only offsets of hectares have anything to show, ?development= is handled by filters.OffsetFilter
         """
-        queryset = models.Offset.objects.filter(type=models.Offset.HECTARES)
-        development = self.request.query_params.get('development', None)
-        if development is not None:
-            queryset = queryset.filter(development__id=development)
-        return queryset
+        return super(OffsetGeoViewSet, self).get_queryset().filter(type=models.Offset.HECTARES)
 
 
-class OffsetViewSet(viewsets.ModelViewSet):
+class OffsetViewSet(ConditionalMixin, BulkMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`, `update` and `destroy` actions.
     """
     metadata_class = serializers.GeoMetadata
     queryset = models.Offset.objects.all()
     serializer_class = serializers.OffsetSerializer
+    select_related_fields = ()
+    prefetch_related_fields = ('implementation_times',)
+    # ?development= goes through the offset's permit
+    version_models = (models.Permit,)
+    filter_class = filters.OffsetFilter
+    ordering_fields = ('id', 'offset_met', 'duration')
+    ordering = ('id',)
 
     def get_queryset(self):
         """
-        Optionally restricts the returned offsets to a given development
+        Only offsets of hectares have anything to show, ?development= is handled by filters.OffsetFilter
         """
-        queryset = models.Offset.objects.filter(type=models.Offset.HECTARES)
-        development = self.request.query_params.get('development', None)
-        if development is not None:
-            queryset = queryset.filter(development__id=development)
-        return queryset
+        return super(OffsetViewSet, self).get_queryset().filter(type=models.Offset.HECTARES)
+
+
+class DevelopmentOffsetSummaryViewSet(ConditionalMixin, StreamingListMixin, SparseQuerysetMixin, EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    The balance of biodiversity lost and gained by each development, e.g. ?ratio__lt=1&ordering=ratio for the
+    developments whose offsets fall furthest short. See core.summaries.
+    """
+    queryset = models.DevelopmentOffsetSummary.objects.all()
+    serializer_class = serializers.DevelopmentOffsetSummarySerializer
+    # ?development__use= reads the developments table
+    version_models = (models.Development,)
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    pagination_class = pagination.SortablePagination
+
+    filter_backends = (DjangoFilterBackend, OrderingFilter)
+    filter_class = filters.DevelopmentOffsetSummaryFilter
+    ordering_fields = ('development', 'total_loss', 'total_gain', 'ratio')
+    ordering = ('development',)
 
 
-class Statistics(viewsets.ViewSet):
+class Statistics(ConditionalMixin, viewsets.ViewSet):
     """
     View to get some statistics from the database
     """
+    version_models = (models.StatisticCount,)
+
+    def list(self, request, format=None):
+        """
+        Return the number of permits each authority has issued, the number of permits issued per year and the number
+        of developments per vegetation type. These are precomputed in core.statistics and kept up to date by signals.
+        """
+        return self.conditional_response(request, lambda: Response(statistics.get_charts()))
+
+
+class Search(ConditionalMixin, viewsets.ViewSet):
+    """
+    Full text search over permits and developments
+    """
+    version_models = (models.Permit, models.Development)
+    max_limit = 100
+
     def list(self, request, format=None):
         """
-        Return the number of permits each authority has issued
+        Return the permits and developments best matching ?q=, by reference number, case officer, consultancy,
+        developer or the words in their titles and descriptions, with the matching words highlighted. ?limit= sets
+        how many of each to return.
         """
-        permits = []
-        for permit in models.Permit.objects.all():
-            development_count = models.Development.objects.filter(permits=permit).count()
-            permits.append({'label': permit.name, 'value': development_count})
-
-        years = models.Permit.objects.all().values('date_issued').annotate(total=Count('date_issued')).order_by('total')
-        returned_years = []
-        for year in years:
-            returned_years.append({'label': year['date_issued'], 'value': year['total']})
-
-        veg_types_dev = models.Development.objects.all().values('geo_info')
-        all_vg = {}
-        for vgd in veg_types_dev:
-            vgd = vgd['geo_info']
-            for key, item in vgd.items():
-                if key in all_vg:
-                    all_vg[key] += 1
-                else:
-                    all_vg[key] = 1
-        # all_vg = sorted(all_vg)
-        returned_vg = []
-
-        for key, item in all_vg.items():
-            returned_vg.append({'label': key, 'value': item})
-
-
-        response = {'Number of developments per permit': {'data': sorted(permits, key=lambda k: k['label']),
-                                                          'x_axis': 'Permits',
-                                                          'y_axis': 'Number of developments',
-                                                          'wide_graph': False},
-                    'Number of permits per year': {'data': sorted(returned_years, key=lambda k: k['label']),
-                                                        'x_axis': 'Years',
-                                                        'y_axis': 'Number of developments',
-                                                        'wide_graph': False},
-                    'Number of vegetation types (developments)': {'data': sorted(returned_vg, key=lambda k: k['label']),
-                                                                  'x_axis': 'Vegetation types',
-                                                                  'y_axis': 'Number of developments',
-                                                                  'wide_graph': True}}
-        return Response(response)
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            raise ParseError('Give the words to search for with ?q=')
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), self.max_limit))
+        except ValueError:
+            raise ParseError('limit must be an integer')
+        return self.conditional_response(request, lambda: Response(self.get_results(text, limit)), cache_data=True)
+
+    def get_results(self, text, limit):
+        results = {}
+        for key, model, view_name in (('permits', models.Permit, 'permit-detail'),
+                                      ('developments', models.Development, 'development-detail')):
+            results[key] = search.search(model, text, limit)
+            for result in results[key]:
+                result['url'] = self.request.build_absolute_uri(reverse(view_name, args=[result['id']]))
+        return results
+
+
+def tile_urls(request):
+    """The prefixes of the hyperlinks in the tiles, the same as the ones the serializers give"""
+    return {name: request.build_absolute_uri(reverse(name + '-list')) + '/'
+            for name in ('development', 'offset', 'permit', 'offsetimplementationtime')}
+
+
+def tile_version(layer):
+    return models.TableVersion.get_versions(tiles.LAYERS[layer]['model'])[tiles.LAYERS[layer]['model']].version
+
+
+def tile_etag(request, layer, z, x, y):
+    if layer not in tiles.LAYERS:
+        return None
+    return tiles.tile_key(layer, tile_version(layer), int(z), int(x), int(y), tile_urls(request))
+
+
+@require_GET
+@condition(etag_func=tile_etag)
+def tile(request, layer, z, x, y):
+    """
+    Mapbox vector tile of the developments or offsets layer, with the same attributes as the geo endpoints.
+    Tiles are cached on disk until the layer's table changes, and clients can revalidate them with If-None-Match.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if layer not in tiles.LAYERS or x >= 2 ** z or y >= 2 ** z:
+        raise Http404('No such tile')
+    data = tiles.get_tile(layer, tile_version(layer), z, x, y, tile_urls(request))
+    return HttpResponse(data, content_type='application/vnd.mapbox-vector-tile')
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
     'rest_framework_gis',
     'core',
     'corsheaders',
+    'django_filters',
     'django_extensions',
 ]
 
@@ -152,11 +153,55 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
         'rest_framework.renderers.TemplateHTMLRenderer',
     ),
+    # Every list endpoint declares its filter_class and ordering_fields, see core.filters
+    'DEFAULT_FILTER_BACKENDS': (
+        'django_filters.rest_framework.DjangoFilterBackend',
+        'rest_framework.filters.OrderingFilter',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.IdCursorPagination',
     'PAGE_SIZE': 50,
     'DATE_FORMAT': '%d %b %Y'
 }
 
 
+# Caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Serialized list pages, see core.views.ConditionalMixin. Entries are keyed on the table versions, so they never go
+    # stale, they only stop being used. To share them between processes use
+    # 'django.core.cache.backends.filebased.FileBasedCache' with a LOCATION directory instead.
+    'api': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'api',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+API_CACHE = 'api'
+
+
+# Vegetation lookups
+
+VEGMAP_IDENTIFY_URL = 'http://bgismaps.sanbi.org/arcgis/rest/services/2012VegMap/MapServer/identify'
+VEGMAP_WORKERS = 8
+VEGMAP_RETRIES = 3
+VEGMAP_BACKOFF = 0.5
+VEGMAP_TIMEOUT = 30
+
+# Results from the VegMap identify service are cached in the AreaInfo table, see core.services
+AREA_INFO_CACHE_TTL = 60 * 60 * 24 * 90
+AREA_INFO_CACHE_MAX_ENTRIES = 50000
+
+
+# Map tiles
+
+# Vector tiles are cached here until the table they were built from changes, see core.tiles
+TILE_CACHE_DIR = os.path.join(BASE_DIR, 'tile-cache')
+
+
 # Local settings
 
 CORS_ORIGIN_WHITELIST = (
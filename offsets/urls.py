@@ -15,7 +15,7 @@ Including another URLconf
 """
 from django.conf.urls import url, include
 from django.contrib import admin
-from core import views
+from core import serializers, views
 from rest_framework.routers import DefaultRouter
 
 # Create a router and register our viewsets with it.
@@ -29,10 +29,16 @@ router.register(r'biodiversity-gain', views.BiodiversityGainViewSet)
 router.register(r'implementation-times', views.ImplementationTimeViewSet)
 router.register(r'offsets-geo', views.OffsetGeoViewSet, base_name='offsets-geo')
 router.register(r'offsets', views.OffsetViewSet)
+router.register(r'offset-summaries', views.DevelopmentOffsetSummaryViewSet)
 router.register(r'statistics', views.Statistics, base_name='statistics')
+router.register(r'search', views.Search, base_name='search')
+
+# Build the OPTIONS metadata of every endpoint now rather than on the first request for each form
+serializers.GeoMetadata.warm(router.registry)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^tiles/(?P<layer>[a-z]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$', views.tile, name='tile'),
     url(r'^', include(router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]